@@ -7,7 +7,10 @@
 __version__ = '0.1.7'
 __author__ = 'Alexander-Maurice Illig'
 
-from ._encoding import Encode, get_data, generate_dataframe
+from ._encoding import Encode, ParallelEncoder, get_data, generate_dataframe, iter_data, stream_data, CsvWriter
+from ._cache import EncodingCache, PredictionCache
+from ._storage import NpyWriter, save_data, load_data
+from ._library import Library, score_library
 from ._predictors import CombinedPredictor
-from ._explore import Explore
+from ._explore import Explore, ExploreExecutor
 from ._utils import *
\ No newline at end of file
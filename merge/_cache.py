@@ -0,0 +1,275 @@
+# version         v0.1.7
+# date            30.01.2024
+# author          Alexander-Maurice Illig
+# affilation      Institute of Biotechnology, RWTH Aachen
+# email           a.illig@biotec.rwth-aachen.de
+
+import os
+import time
+import sqlite3
+import weakref
+from multiprocessing.managers import BaseManager
+import numpy as np
+from collections import OrderedDict
+
+_encodingCaches = weakref.WeakSet()
+
+def _reset_after_fork():
+    for cache in list(_encodingCaches):
+        cache._reset()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+class EncodingCache:
+    """
+    Description
+    -----------
+    Persistent on-disk cache (SQLite) of encoded variants. Entries are keyed by a namespace
+    (hash of the 'params' file and starting position, see 'Encode.cacheNamespace') and the
+    canonicalized variant. If more than 'maxEntries' entries are stored, the least recently
+    used entries are evicted. The cache can be shared by several processes.
+    New entries and the access times of hits are buffered in memory and written in one transaction
+    every 'batchSize' entries (and on 'flush'/'close'), i.e. other processes see them with a delay.
+    Eviction removes the least recently used entries down to 90 % of 'maxEntries' at once, so that
+    the entries are counted only rarely. In forked child processes, the connection of the parent is
+    discarded and a new connection is opened on first use.
+
+    Attributes
+    ----------
+    cacheFile : str
+        Name of the SQLite database file.
+    maxEntries : int
+        Maximum number of cached encodings (default = 1000000).
+    batchSize : int
+        Number of buffered new entries or access times written per transaction (default = 1000).
+    """
+    def __init__(self, cacheFile:str, maxEntries=1000000, batchSize=1000):
+        self.cacheFile = cacheFile
+        self.maxEntries = maxEntries
+        self.batchSize = batchSize
+        self._connection = None
+        self._nEntries = None
+        self._pending = {}
+        self._used = {}
+        self.hits = 0
+        self.misses = 0
+        _encodingCaches.add(self)
+
+    def _reset(self):
+        # an open SQLite connection must not be used across fork(); the buffers belong to the parent
+        self._connection = None
+        self._nEntries = None
+        self._pending = {}
+        self._used = {}
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.cacheFile, timeout=60)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS encodings (namespace TEXT, variant TEXT, x BLOB, used REAL, PRIMARY KEY (namespace, variant))')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS encodings_used ON encodings (used)')
+            self._nEntries, = self._connection.execute('SELECT COUNT(*) FROM encodings').fetchone()
+        return self._connection
+
+    def __getstate__(self):
+        self.flush() # buffered entries would otherwise be written twice or lost
+        state = self.__dict__.copy()
+        state['_connection'] = None # connections can not be pickled, reconnect on first use
+        state['_nEntries'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        _encodingCaches.add(self)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def get(self, namespace:str, variants:list) -> dict:
+        """
+        Description
+        -----------
+        Looks up canonicalized variants.
+
+        Returns
+        -------
+        Dictionary mapping the cached variants to their encodings.
+        """
+        found = {}
+        variants = list(dict.fromkeys(variants))
+        lookup = []
+        for variant in variants:
+            if (namespace, variant) in self._pending:
+                found[variant] = self._pending[(namespace, variant)]
+            else:
+                lookup.append(variant)
+
+        for start in range(0, len(lookup), 500): # SQLite limits the number of query parameters
+            chunk = lookup[start:start+500]
+            rows = self.connection.execute(
+                'SELECT variant, x FROM encodings WHERE namespace=? AND variant IN (%s)'%(','.join('?'*len(chunk))),
+                [namespace, *chunk]
+                )
+            found.update((variant, np.frombuffer(x, dtype=float)) for variant, x in rows)
+
+        now = time.time()
+        self._used.update(((namespace, variant), now) for variant in found)
+        if len(self._used) >= self.batchSize:
+            self.flush()
+
+        self.hits += len(found)
+        self.misses += len(variants) - len(found)
+        return found
+
+    def put(self, namespace:str, variants:list, X:np.ndarray):
+        """
+        Description
+        -----------
+        Buffers the encodings 'X' of the canonicalized 'variants', see 'flush'.
+        """
+        self._pending.update(((namespace, variant), np.asarray(x, dtype=float).copy()) for variant, x in zip(variants, X))
+        if len(self._pending) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        """
+        Description
+        -----------
+        Writes the buffered entries and access times and evicts the least recently used entries.
+        """
+        if not self._pending and not self._used:
+            return
+        now = time.time()
+        connection = self.connection
+        with connection:
+            changes = connection.total_changes
+            connection.executemany('INSERT OR IGNORE INTO encodings VALUES (?, ?, ?, ?)',
+                [(namespace, variant, x.tobytes(), now) for (namespace, variant), x in self._pending.items()])
+            self._nEntries += connection.total_changes - changes
+            connection.executemany('UPDATE encodings SET used=? WHERE namespace=? AND variant=?',
+                [(used, namespace, variant) for (namespace, variant), used in self._used.items()])
+
+            if self._nEntries > self.maxEntries:
+                self._nEntries, = connection.execute('SELECT COUNT(*) FROM encodings').fetchone() # other processes may have evicted
+                if self._nEntries > self.maxEntries:
+                    nEvict = self._nEntries - int(0.9*self.maxEntries)
+                    connection.execute('DELETE FROM encodings WHERE rowid IN (SELECT rowid FROM encodings ORDER BY used LIMIT ?)', (nEvict,))
+                    self._nEntries -= nEvict
+        self._pending.clear()
+        self._used.clear()
+
+    def clear(self):
+        self._pending.clear()
+        self._used.clear()
+        with self.connection:
+            self.connection.execute('DELETE FROM encodings')
+        self._nEntries = 0
+
+    def close(self):
+        if self._connection is not None or self._pending or self._used:
+            self.flush()
+            self._connection.close()
+            self._connection = None
+
+class _LRUDict:
+    """
+    Description
+    -----------
+    Dictionary with least recently used eviction. Used per process by 'PredictionCache' and,
+    for the shared tier, hosted in a manager process so that each lookup or insertion is a single call.
+    """
+    def __init__(self, maxSize:int):
+        self.maxSize = maxSize
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+    def size(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+class _CacheManager(BaseManager):
+    pass
+
+_CacheManager.register('LRUDict', _LRUDict)
+
+class PredictionCache:
+    """
+    Description
+    -----------
+    In-memory cache mapping canonicalized variants to predicted fitness values with LRU eviction.
+    If 'shared' is True, entries are additionally stored in a second LRU tier hosted by a manager process
+    that is consulted by all worker processes on local misses (bounded by 'maxSize' as well).
+
+    Attributes
+    ----------
+    maxSize : int
+        Maximum number of cached predictions per tier (default = 100000).
+    shared : bool
+        Share the predictions across worker processes (default = False).
+    hits : int
+        Number of lookups answered from the cache.
+    misses : int
+        Number of lookups not answered from the cache.
+    """
+    def __init__(self, maxSize=100000, shared=False):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._local = _LRUDict(maxSize)
+        self._manager = None
+        self._shared = None
+        if shared:
+            self._manager = _CacheManager()
+            self._manager.start()
+            self._shared = self._manager.LRUDict(maxSize)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_manager'] = None # workers only need the proxy of the shared tier
+        return state
+
+    def get(self, variant:str):
+        """
+        Description
+        -----------
+        Returns the cached fitness of the canonicalized 'variant' or None.
+        """
+        fitness = self._local.get(variant)
+        if fitness is None and self._shared is not None:
+            fitness = self._shared.get(variant)
+            if fitness is not None:
+                self._local.put(variant, fitness)
+
+        if fitness is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return fitness
+
+    def put(self, variant:str, fitness:float):
+        self._local.put(variant, fitness)
+        if self._shared is not None:
+            self._shared.put(variant, fitness)
+
+    def clear(self):
+        self._local.clear()
+        if self._shared is not None:
+            self._shared.clear()
@@ -4,12 +4,161 @@
 # affilation      Institute of Biotechnology, RWTH Aachen
 # email           a.illig@biotec.rwth-aachen.de
 
+import os
+import copy
+import hashlib
+import tempfile
 import numpy as np
 import pandas as pd
 import multiprocessing
 
-from ._utils import get_single_substitutions
-from ._errors import ActiveSiteError
+from ._utils import get_single_substitutions, canonicalize_variant, is_valid_substitution, X_to_deltaE
+from ._errors import ActiveSiteError, InvalidVariantError
+from ._storage import NpyWriter
+
+class Couplings:
+    """
+    Compact storage of site-site blocks (e.g. couplings 'Jij' or pair frequencies 'fij').
+    Only the blocks of the upper triangle (i<j) are kept, the blocks of the lower triangle
+    are obtained by transposition on access and the diagonal blocks are zero, i.e.
+    indexing behaves like the dense symmetric (L, L, q, q) array.
+
+    Attributes
+    ----------
+    blocks : np.ndarray
+        Packed blocks of shape (L*(L-1)/2, q, q) in the order of np.triu_indices(L, k=1).
+        May be a np.memmap of the 'params' file.
+    L : int
+        Number of sites.
+    """
+    def __init__(self, blocks:np.ndarray, L:int):
+        self.blocks = blocks
+        self.L = int(L)
+        self.q = blocks.shape[-1]
+        self.shape = (self.L, self.L, self.q, self.q)
+
+        i, j = np.triu_indices(self.L, k=1)
+        self.pairIndex = np.full((self.L, self.L), -1, dtype=np.int64)
+        self.pairIndex[i,j] = np.arange(i.size)
+        self.pairIndex[j,i] = np.arange(i.size)
+        self._pairs = (i, j)
+        self._columnOrder = np.argsort(j, kind='stable')
+
+    def __getitem__(self, key:tuple):
+        """
+        Description
+        -----------
+        Advanced indexing with integers or integer arrays that are broadcast against each other.
+        'couplings[i,j]' returns the (q, q) block(s) of the site pair(s), 'couplings[i,j,a,b]'
+        returns the coupling value(s) of amino acid index 'a' at 'i' and 'b' at 'j'.
+        """
+        i, j = np.asarray(key[0]), np.asarray(key[1])
+        pair = self.pairIndex[i,j]
+        lower = i > j
+        diagonal = pair < 0
+        pair = np.where(diagonal, 0, pair)
+
+        if len(key) == 2:
+            blocks = self.blocks[pair]
+            blocks = np.where(lower[...,None,None], np.swapaxes(blocks, -1, -2), blocks)
+            return np.where(diagonal[...,None,None], np.float32(0), blocks)
+
+        a, b = np.asarray(key[2]), np.asarray(key[3])
+        values = self.blocks[pair, np.where(lower, b, a), np.where(lower, a, b)]
+        return np.where(diagonal, np.float32(0), values)
+
+    def site_sums(self, sequences:np.ndarray, chunkSize=2**22) -> np.ndarray:
+        """
+        Description
+        -----------
+        Calculates sum_j J[i,j,A_i,A_j] for every site 'i' of integer-coded sequences.
+
+        Parameters
+        ----------
+        sequences : np.ndarray
+            Integer array of shape (N, L) holding the amino acid indices of N sequences.
+        chunkSize : int
+            Maximum number of gathered coupling values per vectorized pass (default=2**22).
+
+        Returns
+        -------
+        sums : np.ndarray
+            Array of shape (N, L) (float64).
+        """
+        sequences = np.atleast_2d(sequences)
+        sums = np.zeros(sequences.shape, dtype=float)
+        if self.L < 2:
+            return sums
+
+        i, j = self._pairs
+        pairs = np.arange(i.size)
+        rowStarts = np.searchsorted(i, np.arange(self.L-1))
+        columnStarts = np.searchsorted(j[self._columnOrder], np.arange(1, self.L))
+
+        step = max(1, chunkSize//i.size)
+        for start in range(0, sequences.shape[0], step):
+            chunk = sequences[start:start+step]
+            values = self.blocks[pairs, chunk[:,i], chunk[:,j]].astype(float)
+            sums[start:start+step,:-1] += np.add.reduceat(values, rowStarts, axis=1)
+            sums[start:start+step,1:] += np.add.reduceat(values[:,self._columnOrder], columnStarts, axis=1)
+        return sums
+
+    def single_site_sums(self, sequence:np.ndarray) -> np.ndarray:
+        """
+        Description
+        -----------
+        Calculates sum_j J[i,j,a,A_j] for every site 'i' and every amino acid index 'a'
+        when all other sites are occupied as in the integer-coded 'sequence'.
+
+        Parameters
+        ----------
+        sequence : np.ndarray
+            Integer array of shape (L,) holding amino acid indices.
+
+        Returns
+        -------
+        sums : np.ndarray
+            Array of shape (L, q) (float64).
+        """
+        sums = np.zeros((self.L, self.q), dtype=float)
+        if self.L < 2:
+            return sums
+
+        i, j = self._pairs
+        pairs = np.arange(i.size)
+        rowStarts = np.searchsorted(i, np.arange(self.L-1))
+        columnStarts = np.searchsorted(j[self._columnOrder], np.arange(1, self.L))
+
+        sums[:-1] += np.add.reduceat(self.blocks[pairs,:,sequence[j]].astype(float), rowStarts, axis=0)
+        sums[1:] += np.add.reduceat(self.blocks[pairs,sequence[i],:].astype(float)[self._columnOrder], columnStarts, axis=0)
+        return sums
+
+    def __reduce__(self):
+        """
+        Memory-mapped blocks are pickled as a reference to the 'params' file instead of a copy.
+        """
+        if isinstance(self.blocks, np.memmap) and self.blocks.filename is not None:
+            return (_memmap_couplings, (self.blocks.filename, self.blocks.offset, self.blocks.shape, self.L))
+        return (Couplings, (np.asarray(self.blocks), self.L))
+
+    @property
+    def nbytes(self) -> int:
+        return self.blocks.nbytes + self.pairIndex.nbytes
+
+    def toarray(self) -> np.ndarray:
+        """
+        Description
+        -----------
+        Returns the dense symmetric array of shape (L, L, q, q).
+        """
+        i, j = np.triu_indices(self.L, k=1)
+        dense = np.zeros(self.shape, dtype=self.blocks.dtype)
+        dense[i,j] = self.blocks
+        dense[j,i] = np.swapaxes(self.blocks, -1, -2)
+        return dense
+
+def _memmap_couplings(filename:str, offset:int, shape:tuple, L:int) -> Couplings:
+    return Couplings(np.memmap(filename, dtype='float32', mode='r', offset=offset, shape=shape), L)
 
 class PLMC:
     """
@@ -20,8 +169,15 @@ class PLMC:
     ----------
     paramsFile: str
         Binary parameter file outputed by PLMC.
+    memoryMap: bool
+        If True, the coupling blocks are memory-mapped from 'paramsFile' instead of being
+        read into memory (default=False).
+
+    'weights', 'fi', and 'fij' are loaded lazily on first access.
     """
-    def __init__(self, paramsFile:str):
+    def __init__(self, paramsFile:str, memoryMap=False):
+        self.paramsFile = paramsFile
+        self.memoryMap = memoryMap
         self._read_paramsFile(paramsFile)
         self.alphabet2index = {aminoAcid:i for i,aminoAcid in enumerate(self.alphabet)}
         self.position2index = {position:i for i,position in enumerate(self.offsetMap)}
@@ -31,34 +187,101 @@ class PLMC:
         Description
         -----------
         Initializes the PLMC class by extracting information from the binaray 'params' file.
+        The sequence weights 'weights', single site frequencies 'fi', and pair frequencies 'fij'
+        are not needed for the encoding and are only read on first access.
         
         Parameters
         ----------
         paramsFile : str
             Name of the binary 'params' file.
         """
+        self._offsets = {}
+        self._weights, self._fi, self._fij = None, None, None
+
         with open(paramsFile, 'rb') as f:
             self.L,self.q,self.numSeqs,self.numInvalidSeqs,self.numIter = np.fromfile(f, dtype='int32', count=5)
             self.theta,self.lambdaH,self.lambdaJ,self.lambdaGroup,self.nEff = np.fromfile(f, dtype='float32', count=5)
             self.alphabet = np.fromfile(f, dtype='S1', count=self.q).astype('U1')
-            self.weights = np.fromfile(f, dtype='float32', count=self.numSeqs+self.numInvalidSeqs)
+            self._skip(f, 'weights', 4*(int(self.numSeqs)+int(self.numInvalidSeqs)))
             self.targetSeq = np.fromfile(f, dtype='S1', count=self.L).astype('U1')
             self.offsetMap = np.fromfile(f, dtype='int32', count=self.L)
-            self.fi, = np.fromfile(f, dtype=('float32', (self.L, self.q)), count=1)
+            self._skip(f, 'fi', 4*int(self.L)*int(self.q))
             self.hi, = np.fromfile(f, dtype=('float32', (self.L, self.q)), count=1)
+            self._skip(f, 'fij', 4*int(self.L)*(int(self.L)-1)//2*int(self.q)**2)
+            self.Jij = Couplings(self._read_blocks(f, paramsFile), self.L)
+
+    def _skip(self, f, section:str, nBytes:int):
+        """
+        Description
+        -----------
+        Remembers the offset of 'section' in the 'params' file and moves the file position behind it.
+        """
+        self._offsets[section] = f.tell()
+        f.seek(nBytes, 1)
+
+    def _open_section(self, section:str):
+        f = open(self.paramsFile, 'rb')
+        f.seek(self._offsets[section])
+        return f
+
+    @property
+    def weights(self) -> np.ndarray:
+        """
+        Sequence weights, read from 'paramsFile' on first access.
+        """
+        if self._weights is None:
+            with self._open_section('weights') as f:
+                self._weights = np.fromfile(f, dtype='float32', count=self.numSeqs+self.numInvalidSeqs)
+        return self._weights
+
+    @property
+    def fi(self) -> np.ndarray:
+        """
+        Single site frequencies, read from 'paramsFile' on first access.
+        """
+        if self._fi is None:
+            with self._open_section('fi') as f:
+                self._fi, = np.fromfile(f, dtype=('float32', (self.L, self.q)), count=1)
+        return self._fi
+
+    @property
+    def fij(self) -> Couplings:
+        """
+        Pair frequencies, read from 'paramsFile' on first access.
+        """
+        if self._fij is None:
+            with self._open_section('fij') as f:
+                self._fij = Couplings(self._read_blocks(f, self.paramsFile), self.L)
+        return self._fij
+
+    def _read_blocks(self, f, paramsFile:str) -> np.ndarray:
+        """
+        Description
+        -----------
+        Reads the packed upper triangle (i<j, row-major) of site-site blocks with a single read
+        or memory-maps it if 'memoryMap' is set.
+
+        Parameters
+        ----------
+        f : file object
+            Opened 'params' file positioned at the start of the packed blocks.
+        paramsFile : str
+            Name of the binary 'params' file.
+
+        Returns
+        -------
+        blocks : np.ndarray
+            Array of shape (L*(L-1)/2, q, q) containing the blocks in the order of np.triu_indices(L, k=1).
+        """
+        shape = (int(self.L)*(int(self.L)-1)//2, int(self.q), int(self.q))
+        if self.memoryMap:
+            offset = f.tell()
+            blocks = np.memmap(paramsFile, dtype='float32', mode='r', offset=offset, shape=shape)
+            f.seek(offset + blocks.nbytes)
+            return blocks
+
+        return np.fromfile(f, dtype='float32', count=np.prod(shape)).reshape(shape)
 
-            self.fij = np.zeros((self.L, self.L, self.q, self.q), dtype='float32')
-            for i in range(self.L-1):
-                for j in range(i+1, self.L):
-                    self.fij[i,j], = np.fromfile(f, dtype=('float32', (self.q, self.q)), count=1)
-                    self.fij[j,i] = self.fij[i,j].T
-
-            self.Jij = np.zeros((self.L, self.L, self.q, self.q), dtype=('float32'))
-            for i in range(self.L-1):
-                for j in range(i+1, self.L):
-                    self.Jij[i,j], = np.fromfile(f, dtype=('float32', (self.q, self.q)), count=1)     
-                    self.Jij[j,i] = self.Jij[i,j].T
-                    
 class Encode(PLMC):
     """
     Class for performing the 'DCA-based encoding'.
@@ -69,13 +292,33 @@ class Encode(PLMC):
         Number of leading residue of the fasta sequence used for model construction.
     paramsFile: str
         Binary parameter file outputed by PLMC.
+    memoryMap: bool
+        If True, the coupling blocks are memory-mapped from 'paramsFile' (default=False).
+    cache: object
+        Optional 'EncodingCache' consulted before encoding variants (default=None).
     """
 
-    def __init__(self,startingPosition:int, paramsFile:str):
+    def __init__(self,startingPosition:int, paramsFile:str, memoryMap=False, cache=None):
         self.startingPosition=startingPosition
-        super().__init__(paramsFile) # inherit functions and variables from class 'PLMC'
+        self.cache=cache
+        self._paramsHash=None
+        super().__init__(paramsFile, memoryMap) # inherit functions and variables from class 'PLMC'
+        self.targetIndices = np.array([self.alphabet2index[Ai] for Ai in self.targetSeq])
         self.xWt = self._encode_wt()
 
+    @property
+    def cacheNamespace(self) -> str:
+        """
+        Key of the encodings of this model in an 'EncodingCache': hash of 'paramsFile' and 'startingPosition'.
+        """
+        if self._paramsHash is None:
+            sha256=hashlib.sha256()
+            with open(self.paramsFile,'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    sha256.update(block)
+            self._paramsHash=sha256.hexdigest()
+        return '%s:%d'%(self._paramsHash,self.startingPosition)
+
     def _get_position_internal(self, position:int):
         """
         Description
@@ -124,11 +367,8 @@ class Encode(PLMC):
         Ji : float
             Sum of all site-site interaction terms acting on position 'i' when occupied with 'Ai'.
         """
-        Ji=0.0
-        for j,Aj in enumerate(sequence):
-            Aj_index = self.alphabet2index[Aj]        
-            Ji+=self.Jij[i,j,Ai_index,Aj_index]
-        return Ji
+        Aj_indices=np.array([self.alphabet2index[Aj] for Aj in sequence])
+        return np.sum(self.Jij[i,np.arange(sequence.size),Ai_index,Aj_indices], dtype=float)
 
     @staticmethod
     def _unpack_substitution(substitution:str) -> tuple:
@@ -169,7 +409,38 @@ class Encode(PLMC):
         X_var : np.ndarray
             Encoded sequence of the variant.
         """
-        sequence=self.targetSeq.copy()
+        if self.cache is not None:
+            key=canonicalize_variant(variant,separator)
+            cached=self.cache.get(self.cacheNamespace,[key])
+            if key in cached:
+                return cached[key].copy()
+
+        positions,aminoAcids=self._parse_variant(variant,separator)
+        X_var=self._encode_mutations(positions[None], aminoAcids[None])[0]
+
+        if self.cache is not None:
+            self.cache.put(self.cacheNamespace,[key],[X_var])
+        return X_var
+
+    def _parse_variant(self, variant:str, separator=',') -> tuple:
+        """
+        Description
+        -----------
+        Converts the variant into internal site indices and amino acid indices of its substitutions.
+        If a position is substituted more than once, the last substitution is kept.
+
+        Parameters
+        ----------
+        See '_encode_variant' for an explanation.
+
+        Returns
+        -------
+        positions : np.ndarray
+            Internal site indices (0, ..., L-1) of the substitutions.
+        aminoAcids : np.ndarray
+            Indices of the introduced amino acids (see 'alphabet2index').
+        """
+        substitutions={}
         for substitution in get_single_substitutions(variant,separator):
             wild_type_aa,position,Ai=self._unpack_substitution(substitution)
          
@@ -177,14 +448,388 @@ class Encode(PLMC):
             if not i:
                 raise ActiveSiteError(position,variant)
 
-            i_mapped=self.position2index[i]
-            sequence[i_mapped]=Ai
+            substitutions[self.position2index[i]]=self.alphabet2index[Ai]
 
-        X_var=np.zeros(sequence.size,dtype=float)
-        for i,Ai in enumerate(sequence):
-            Ai_index=self.alphabet2index[Ai]
-            X_var[i]=self.hi[i,Ai_index] + 0.5*self.Ji(i,Ai_index,sequence)
-        return X_var
+        return np.array(list(substitutions.keys()),dtype=int),np.array(list(substitutions.values()),dtype=int)
+
+    def _encode_mutations(self, positions:np.ndarray, aminoAcids:np.ndarray, mask=None) -> np.ndarray:
+        """
+        Description
+        -----------
+        Encodes variants incrementally from the cached wild-type encoding 'xWt'.
+        Sites that are not substituted only change by the couplings to the k substituted sites,
+        substituted sites are recalculated, i.e. the costs are O(k*L) instead of O(L^2) per variant.
+
+        Parameters
+        ----------
+        positions : np.ndarray
+            Integer array of shape (N, k) holding the internal site indices of the substitutions.
+            Valid site indices have to be unique within a row.
+        aminoAcids : np.ndarray
+            Integer array of shape (N, k) holding the indices of the introduced amino acids.
+        mask : np.ndarray
+            Boolean array of shape (N, k) marking the valid entries of rows with less than k
+            substitutions (default=None, i.e. all entries are valid).
+
+        Returns
+        -------
+        X : np.ndarray
+            Encoded sequences of shape (N, L).
+        """
+        positions,aminoAcids=np.atleast_2d(positions),np.atleast_2d(aminoAcids)
+        if mask is None:
+            mask=np.ones(positions.shape,dtype=bool)
+        positions=np.where(mask,positions,0)
+        wt=self.targetIndices
+        sites=np.arange(self.L)
+        rows=np.broadcast_to(np.arange(positions.shape[0])[:,None],positions.shape)
+
+        # couplings of all sites to the substituted sites
+        wtAminoAcids=wt[positions]
+        delta=self.Jij[sites,positions[...,None],wt,aminoAcids[...,None]].astype(float) - self.Jij[sites,positions[...,None],wt,wtAminoAcids[...,None]]
+        X=self.xWt + 0.5*np.sum(delta*mask[...,None],axis=1)
+
+        # substituted sites
+        sequences=np.tile(wt,(positions.shape[0],1))
+        sequences[rows[mask],positions[mask]]=aminoAcids[mask]
+        Ji=np.sum(self.Jij[positions[...,None],sites,aminoAcids[...,None],sequences[:,None,:]],axis=-1,dtype=float)
+        X[rows[mask],positions[mask]]=(self.hi[positions,aminoAcids] + 0.5*Ji)[mask]
+        return X
+
+    def encode_batch(self, variants, separator=',', chunkSize=1000) -> tuple:
+        """
+        Description
+        -----------
+        Encodes many variants at once. The variants are parsed into an integer mutation tensor
+        of shape (N, k) (k: maximum number of substitutions) that is encoded in vectorized passes
+        of 'chunkSize' variants. Variants raising 'ActiveSiteError' or 'InvalidVariantError'
+        are not encoded but flagged in the returned mask.
+
+        Parameters
+        ----------
+        variants : list or np.ndarray
+            Variants to encode (see '_encode_variant').
+        separator : str
+            Character to split the variant to obtain the single substitutions (default=',').
+        chunkSize : int
+            Number of variants encoded per vectorized pass (default=1000).
+
+        Returns
+        -------
+        X : np.ndarray
+            Encoded sequences of shape (N, L), rows of rejected variants are NaN.
+        deltaE : np.ndarray
+            DeltaE of the variants (N,), NaN for rejected variants.
+        valid : np.ndarray
+            Boolean mask (N,), False for rejected variants.
+        """
+        if self.cache is not None:
+            return self._encode_cached(variants,separator,lambda misses: self._encode_batch(misses,separator,chunkSize))
+        return self._encode_batch(variants,separator,chunkSize)
+
+    def _encode_cached(self, variants, separator, encode) -> tuple:
+        """
+        Description
+        -----------
+        Looks up the canonicalized variants in 'cache', encodes the misses using 'encode',
+        and stores the new encodings. See 'encode_batch' for the returned values.
+
+        Parameters
+        ----------
+        variants : list or np.ndarray
+            Variants to encode.
+        separator : str
+            Character to split the variant to obtain the single substitutions.
+        encode : callable
+            Function encoding a np.ndarray of variants, returns (X, deltaE, valid).
+        """
+        keys=[]
+        for variant in variants:
+            try:
+                keys.append(canonicalize_variant(variant,separator))
+            except InvalidVariantError:
+                keys.append(None)
+
+        cached=self.cache.get(self.cacheNamespace,[key for key in keys if key is not None])
+        X=np.full((len(keys),self.L),np.nan)
+        valid=np.ones(len(keys),dtype=bool)
+        for n,key in enumerate(keys):
+            if key in cached:
+                X[n]=cached[key]
+
+        misses=np.array([n for n,key in enumerate(keys) if key not in cached],dtype=int)
+        if misses.size:
+            X[misses],_,valid[misses]=encode(np.asarray(variants,dtype=object)[misses])
+            new=misses[valid[misses]]
+            self.cache.put(self.cacheNamespace,[keys[n] for n in new],X[new])
+
+        return X,X_to_deltaE(X,self.xWt),valid
+
+    def _encode_batch(self, variants, separator=',', chunkSize=1000) -> tuple:
+        positions,aminoAcids,mask,valid=self._parse_variants(variants,separator)
+
+        X=np.full((valid.size,self.L),np.nan)
+        for start in range(0,valid.size,chunkSize):
+            rows=np.flatnonzero(valid[start:start+chunkSize])+start
+            if rows.size:
+                X[rows]=self._encode_mutations(positions[rows],aminoAcids[rows],mask[rows])
+
+        return X,X_to_deltaE(X,self.xWt),valid
+
+    def delta_energy(self, variants, separator=',', chunkSize=100000) -> tuple:
+        """
+        Description
+        -----------
+        Calculates deltaE (see 'X_to_deltaE') of many variants without building their encoded sequences.
+        For a variant with substitutions (i_m, a_m), deltaE is the sum of the single substitution
+        values (see '_single_substitution_energies') and the pairwise epistasis terms
+        J_ij(a_i,a_j) - J_ij(a_i,wt_j) - J_ij(wt_i,a_j) + J_ij(wt_i,wt_j) of all substituted pairs,
+        i.e. O(k^2) per variant after an O(L^2*q) precomputation.
+
+        Parameters
+        ----------
+        variants : list or np.ndarray
+            Variants (see '_encode_variant').
+        separator : str
+            Character to split the variant to obtain the single substitutions (default=',').
+        chunkSize : int
+            Number of variants per vectorized pass (default=100000).
+
+        Returns
+        -------
+        deltaE : np.ndarray
+            DeltaE of the variants (N,), NaN for rejected variants.
+        valid : np.ndarray
+            Boolean mask (N,), False for variants raising 'ActiveSiteError' or 'InvalidVariantError'.
+        """
+        positions,aminoAcids,mask,valid=self._parse_variants(variants,separator)
+
+        deltaE=np.full(valid.size,np.nan)
+        for start in range(0,valid.size,chunkSize):
+            rows=np.flatnonzero(valid[start:start+chunkSize])+start
+            if rows.size:
+                deltaE[rows]=self._delta_energy_mutations(positions[rows],aminoAcids[rows],mask[rows])
+        return deltaE,valid
+
+    def _single_substitution_energies(self) -> np.ndarray:
+        """
+        Description
+        -----------
+        Returns (and caches) deltaE of all single substitutions as array of shape (L, q):
+        h_i(a) - h_i(wt_i) + sum_j [J_ij(a,wt_j) - J_ij(wt_i,wt_j)].
+        """
+        if getattr(self,'_singles',None) is None:
+            wt=self.targetIndices
+            sites=np.arange(self.L)
+            couplings=self.Jij.single_site_sums(wt)
+            hi=self.hi.astype(float)
+            self._singles=hi - hi[sites,wt][:,None] + couplings - couplings[sites,wt][:,None]
+        return self._singles
+
+    def _epistasis(self, i, a, j, b) -> np.ndarray:
+        """
+        Description
+        -----------
+        Pairwise epistasis term J_ij(a,b) - J_ij(a,wt_j) - J_ij(wt_i,b) + J_ij(wt_i,wt_j) for broadcastable
+        integer arrays of site indices 'i', 'j' and amino acid indices 'a', 'b' (zero for i == j).
+        """
+        wt=self.targetIndices
+        return (self.Jij[i,j,a,b].astype(float) - self.Jij[i,j,a,wt[j]]
+                - self.Jij[i,j,wt[i],b] + self.Jij[i,j,wt[i],wt[j]])
+
+    def _delta_energy_mutations(self, positions:np.ndarray, aminoAcids:np.ndarray, mask=None) -> np.ndarray:
+        """
+        Description
+        -----------
+        Calculates deltaE from an integer mutation tensor (see '_encode_mutations').
+        """
+        positions,aminoAcids=np.atleast_2d(positions),np.atleast_2d(aminoAcids)
+        if mask is None:
+            mask=np.ones(positions.shape,dtype=bool)
+        positions=np.where(mask,positions,0)
+        aminoAcids=np.where(mask,aminoAcids,self.targetIndices[positions])
+
+        deltaE=np.sum(self._single_substitution_energies()[positions,aminoAcids]*mask,axis=1)
+        k=positions.shape[1]
+        if k > 1:
+            m,n=np.triu_indices(k,k=1)
+            pairs=self._epistasis(positions[:,m],aminoAcids[:,m],positions[:,n],aminoAcids[:,n])
+            deltaE+=np.sum(pairs*(mask[:,m]&mask[:,n]),axis=1)
+        return deltaE
+
+    def _site_indices(self, positions=None) -> np.ndarray:
+        """
+        Description
+        -----------
+        Converts residue positions (numbering of the variants) into internal site indices.
+        If 'positions' is None, all sites are returned.
+        """
+        if positions is None:
+            return np.arange(self.L)
+
+        indices=[]
+        for position in positions:
+            i=self._get_position_internal(position)
+            if not i:
+                raise ActiveSiteError(position,str(position))
+            indices.append(self.position2index[i])
+        return np.array(indices,dtype=int)
+
+    def _substitution_name(self, i:int, a:int) -> str:
+        return '%s%d%s'%(self.targetSeq[i],self.offsetMap[i]+self.startingPosition-1,self.alphabet[a])
+
+    def _substitutable(self) -> np.ndarray:
+        """
+        Description
+        -----------
+        Boolean array of shape (L, q), True if amino acid index 'a' is a valid substitution at site 'i'
+        (amino acid in one letter code that differs from the wild type).
+        """
+        aminoAcids=np.array([is_valid_substitution('A1%s'%(a)) for a in self.alphabet])
+        substitutable=np.tile(aminoAcids,(self.L,1))
+        substitutable[np.arange(self.L),self.targetIndices]=False
+        return substitutable
+
+    def single_substitution_table(self) -> np.ndarray:
+        """
+        Description
+        -----------
+        DeltaE of all single substitutions, calculated in one vectorized pass.
+
+        Returns
+        -------
+        table : np.ndarray
+            Array of shape (L, q), entry [i, a] is deltaE of introducing amino acid 'alphabet[a]'
+            at site 'i' (zero for the wild type amino acid).
+        """
+        return self._single_substitution_energies().copy()
+
+    def pairwise_epistasis(self, positions=None) -> np.ndarray:
+        """
+        Description
+        -----------
+        Pairwise epistasis terms, i.e. the deviation of deltaE of a double substitution from the sum of the
+        single substitution values: J_ij(a,b) - J_ij(a,wt_j) - J_ij(wt_i,b) + J_ij(wt_i,wt_j).
+        The table has P^2*q^2 entries, for many positions use 'top_double_substitutions'.
+
+        Parameters
+        ----------
+        positions : list
+            Residue positions (numbering of the variants) to include (default=None, i.e. all sites).
+
+        Returns
+        -------
+        table : np.ndarray
+            Array of shape (P, q, P, q), entry [m, a, n, b] is the epistasis term of 'a' at positions[m]
+            and 'b' at positions[n].
+        """
+        sites=self._site_indices(positions)
+        aminoAcids=np.arange(self.q)
+        return self._epistasis(sites[:,None,None,None],aminoAcids[None,:,None,None],sites[None,None,:,None],aminoAcids[None,None,None,:])
+
+    def top_single_substitutions(self, k=100, sign=+1) -> list:
+        """
+        Description
+        -----------
+        Returns the 'k' single substitutions with the highest (sign=+1) or lowest (sign=-1) deltaE.
+
+        Returns
+        -------
+        List of tuples (substitution, deltaE).
+        """
+        table=np.where(self._substitutable(),sign*self._single_substitution_energies(),-np.inf)
+        best=np.argsort(table,axis=None,kind='stable')[::-1][:k]
+        return [(self._substitution_name(i,a),sign*table[i,a]) for i,a in zip(*np.unravel_index(best,table.shape)) if np.isfinite(table[i,a])]
+
+    def top_double_substitutions(self, k=100, positions=None, sign=+1, chunkSize=2**24) -> list:
+        """
+        Description
+        -----------
+        Returns the 'k' double substitutions with the highest (sign=+1) or lowest (sign=-1) deltaE.
+        The table of all double substitutions is evaluated in chunks of about 'chunkSize' entries
+        keeping only the current top 'k'.
+
+        Parameters
+        ----------
+        k : int
+            Number of double substitutions to return (default=100).
+        positions : list
+            Residue positions (numbering of the variants) to include (default=None, i.e. all sites).
+        sign : int
+            Either +1 for maxima or -1 for minima (default=+1).
+        chunkSize : int
+            Approximate number of table entries evaluated per vectorized pass (default=2**24).
+
+        Returns
+        -------
+        List of tuples (variant, deltaE).
+        """
+        sites=self._site_indices(positions)
+        singles=sign*self._single_substitution_energies()[sites]
+        substitutable=self._substitutable()[sites]
+        aminoAcids=np.arange(self.q)
+        P=sites.size
+
+        bestValues=np.zeros(0)
+        bestIndices=np.zeros((0,4),dtype=int)
+        step=max(1,chunkSize//(P*self.q*self.q))
+        for start in range(0,P,step):
+            m=np.arange(start,min(start+step,P))
+            n=np.arange(P)
+            values=(singles[m,:,None,None] + singles[None,None,:,:]
+                    + sign*self._epistasis(sites[m,None,None,None],aminoAcids[None,:,None,None],sites[None,None,:,None],aminoAcids[None,None,None,:]))
+            allowed=(substitutable[m,:,None,None] & substitutable[None,None,:,:]
+                     & (sites[m,None,None,None] < sites[None,None,:,None]))
+            values=np.where(allowed,values,-np.inf).ravel()
+
+            candidates=np.argpartition(values,-min(k,values.size))[-k:] if values.size > k else np.arange(values.size)
+            candidates=candidates[np.isfinite(values[candidates])]
+            indices=np.stack(np.unravel_index(candidates,(m.size,self.q,P,self.q)),axis=1)
+            indices[:,0]+=start
+
+            bestValues=np.concatenate([bestValues,values[candidates]])
+            bestIndices=np.concatenate([bestIndices,indices])
+            keep=np.argsort(bestValues,kind='stable')[::-1][:k]
+            bestValues,bestIndices=bestValues[keep],bestIndices[keep]
+
+        return [('%s,%s'%(self._substitution_name(sites[mi],a),self._substitution_name(sites[ni],b)),sign*value)
+                for (mi,a,ni,b),value in zip(bestIndices,bestValues)]
+
+    def _parse_variants(self, variants, separator=',') -> tuple:
+        """
+        Description
+        -----------
+        Converts variants into a padded integer mutation tensor.
+
+        Returns
+        -------
+        positions : np.ndarray
+            Internal site indices of shape (N, k).
+        aminoAcids : np.ndarray
+            Indices of the introduced amino acids of shape (N, k).
+        mask : np.ndarray
+            Boolean array of shape (N, k) marking the valid entries.
+        valid : np.ndarray
+            Boolean array of shape (N,), False for variants raising 'ActiveSiteError' or 'InvalidVariantError'.
+        """
+        parsed=[]
+        valid=np.ones(len(variants),dtype=bool)
+        for n,variant in enumerate(variants):
+            try:
+                parsed.append(self._parse_variant(variant,separator))
+            except (ActiveSiteError,InvalidVariantError):
+                parsed.append((np.zeros(0,dtype=int),np.zeros(0,dtype=int)))
+                valid[n]=False
+
+        k=max([p.size for p,_ in parsed],default=0)
+        positions=np.zeros((len(parsed),k),dtype=int)
+        aminoAcids=np.zeros((len(parsed),k),dtype=int)
+        mask=np.zeros((len(parsed),k),dtype=bool)
+        for n,(p,a) in enumerate(parsed):
+            positions[n,:p.size]=p
+            aminoAcids[n,:a.size]=a
+            mask[n,:p.size]=True
+        return positions,aminoAcids,mask,valid
 
     def _encode_wt(self) -> np.ndarray:
         """
@@ -197,47 +842,166 @@ class Encode(PLMC):
         X_wt : np.ndarray
             Encoded sequence of the wild-type.
         """
-        X_wt=np.zeros(self.targetSeq.size,dtype=float)
-        for i,Ai in enumerate(self.targetSeq):
-            Ai_index=self.alphabet2index[Ai]
-            X_wt[i]=self.hi[i,Ai_index] + 0.5*self.Ji(i,Ai_index,self.targetSeq)
-        return X_wt
+        return self._encode_sequences(self.targetIndices)[0]
+
+    def _encode_sequences(self, sequences:np.ndarray) -> np.ndarray:
+        """
+        Description
+        -----------
+        Encodes integer-coded sequences using their "DCA representation"
+        X_i = h_i(A_i) + 0.5 * sum_j J_ij(A_i, A_j).
+
+        Parameters
+        ----------
+        sequences : np.ndarray
+            Integer array of shape (N, L) or (L,) holding amino acid indices (see 'alphabet2index').
+
+        Returns
+        -------
+        X : np.ndarray
+            Encoded sequences of shape (N, L).
+        """
+        sequences = np.atleast_2d(sequences)
+        return self.hi[np.arange(self.L), sequences] + 0.5*self.Jij.site_sums(sequences)
+
+def _share_encode(dcaEncode:object, directory:str) -> object:
+    """
+    Description
+    -----------
+    Returns a shallow copy of 'dcaEncode' whose coupling blocks are memory-mapped (from 'directory'
+    if 'dcaEncode' was not initialized with memoryMap=True) and therefore pickled as a file reference.
+    Lazily loaded frequencies are dropped.
+    """
+    shared = copy.copy(dcaEncode)
+    shared._weights, shared._fi, shared._fij = None, None, None
+    if not isinstance(shared.Jij.blocks, np.memmap):
+        jijFile = os.path.join(directory, 'Jij.npy')
+        np.save(jijFile, shared.Jij.blocks)
+        shared.Jij = Couplings(np.load(jijFile, mmap_mode='r'), shared.L)
+    return shared
+
+_worker = {}
 
-def _get_data(variants:list, fitnesses:list, dcaEncode:object, data:list) -> list:
+def _init_worker(dcaEncode:object):
     """
     Description
     -----------
-    Get the variant name, the associated fitness value, and its (DCA-)encoded sequence.
+    Pool initializer, stores the shared 'Encode' object once per worker process.
+    """
+    _worker['encode'] = dcaEncode
+
+def _encode_chunk(task:tuple):
+    """
+    Description
+    -----------
+    Encodes a chunk of variants and writes the rows into the shared result arrays.
 
     Parameters
     ----------
-    variants : list
-        List of strings containing the variants to be encoded.
-    fitnesses : list
-        List of floats (1d) containing the fitness values associated to the variants.
+    task : tuple
+        (file of the shared X array, file of the shared valid mask, index of the first row, variants)
+    """
+    xFile, validFile, start, variants = task
+    X, _, valid = _worker['encode'].encode_batch(variants)
+
+    xShared = np.load(xFile, mmap_mode='r+')
+    validShared = np.load(validFile, mmap_mode='r+')
+    xShared[start:start+len(variants)] = X
+    validShared[start:start+len(variants)] = valid
+    xShared.flush()
+    validShared.flush()
+
+class ParallelEncoder:
+    """
+    Description
+    -----------
+    Encodes variants with a pool of worker processes. The coupling blocks are shared read-only
+    through a memory-mapped file (or the memory-mapped 'params' file if 'Encode' was initialized
+    with memoryMap=True), so each worker receives the 'Encode' object once without copying 'Jij'.
+    Workers write their rows directly into a preallocated memory-mapped (N, L) array in input order.
+    Use as context manager or call 'close' to shut down the pool and remove the temporary files.
+
+    Attributes
+    ----------
     dcaEncode : object
         Initialized 'Encode' class object.
-    data : manager.list()
-        Manager.list() object to store the output of multiple processors. 
-
-    Returns
-    -------
-    data : manager.list()
-        Filled list with variant names, fitnesses, and encoded sequence.
+    nProcesses : int
+        Number of processes to be used for parallel execution (default=6).
+    chunkSize : int
+        Number of variants per task (default=1000).
+    tempDir : str
+        Directory for the temporary shared files (default=None, i.e. system default).
     """
-    for variant,fitness in zip(variants,fitnesses):
-        try:
-            data.append([variant,dcaEncode._encode_variant(variant),fitness])
-            
-        except ActiveSiteError:
-            pass 
+    def __init__(self, dcaEncode:object, nProcesses=6, chunkSize=1000, tempDir=None):
+        self.dcaEncode = dcaEncode
+        self.nProcesses = nProcesses
+        self.chunkSize = chunkSize
+        self._directory = tempfile.TemporaryDirectory(dir=tempDir)
+        self._nCalls = 0
+        self.pool = None
+        if nProcesses > 1:
+            self.pool = multiprocessing.Pool(nProcesses, initializer=_init_worker, initargs=(self.shared_encode(),))
+
+    def shared_encode(self) -> object:
+        """
+        Description
+        -----------
+        Returns a copy of 'dcaEncode' for the workers, see '_share_encode'.
+        """
+        shared = _share_encode(self.dcaEncode, self._directory.name)
+        shared.cache = None # the cache is consulted by the parent process
+        return shared
+
+    def encode(self, variants) -> tuple:
+        """
+        Description
+        -----------
+        Encodes the variants in parallel, see 'Encode.encode_batch' for the returned values.
+        If 'dcaEncode' has a cache, only cache misses are sent to the workers.
+        """
+        if self.pool is None:
+            return self.dcaEncode.encode_batch(variants, chunkSize=self.chunkSize)
+
+        if self.dcaEncode.cache is not None:
+            return self.dcaEncode._encode_cached(variants, ',', self._encode_parallel)
+        return self._encode_parallel(variants)
+
+    def _encode_parallel(self, variants) -> tuple:
+
+        self._nCalls += 1
+        xFile = os.path.join(self._directory.name, 'X%d.npy'%(self._nCalls))
+        validFile = os.path.join(self._directory.name, 'valid%d.npy'%(self._nCalls))
+        np.lib.format.open_memmap(xFile, mode='w+', dtype=float, shape=(len(variants), int(self.dcaEncode.L)))
+        np.lib.format.open_memmap(validFile, mode='w+', dtype=bool, shape=(len(variants),))
+
+        tasks = [(xFile, validFile, start, variants[start:start+self.chunkSize]) for start in range(0, len(variants), self.chunkSize)]
+        for _ in self.pool.imap_unordered(_encode_chunk, tasks):
+            pass
+
+        X, valid = np.load(xFile), np.load(validFile)
+        os.remove(xFile)
+        os.remove(validFile)
+        return X, X_to_deltaE(X, self.dcaEncode.xWt), valid
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self._directory.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 def get_data(fitnessKey:str, csvFile:str, dcaEncode:object, nProcesses=6):
     """
     Description
     -----------
     This function allows to generate the encoded sequences based on the variants
-    given in 'csvFile' in a parallel manner.
+    given in 'csvFile' in a parallel manner (see 'ParallelEncoder').
     
     Parameters
     ----------
@@ -253,7 +1017,8 @@ def get_data(fitnessKey:str, csvFile:str, dcaEncode:object, nProcesses=6):
     Returns
     -------
     data : np.ndarray
-        Filled numpy array including variant names, fitnesses, and encoded sequences.
+        Filled numpy array including variant names, fitnesses, and encoded sequences
+        in the order of 'csvFile'.
     """
 
     df=pd.read_csv(csvFile,sep=';',comment='#')
@@ -267,23 +1032,128 @@ def get_data(fitnessKey:str, csvFile:str, dcaEncode:object, nProcesses=6):
         fitnesses=np.delete(fitnesses,idxs_nan)
         variants=np.delete(variants,idxs_nan)
 
-    fitnesses_split=np.array_split(fitnesses,nProcesses)
-    variants_split=np.array_split(variants,nProcesses)
+    chunkSize=max(1,int(np.ceil(variants.size/nProcesses)))
+    with ParallelEncoder(dcaEncode, nProcesses=nProcesses, chunkSize=min(chunkSize,1000)) as encoder:
+        X,_,valid=encoder.encode(variants)
+
+    if not valid.all():
+        print('Rejected variants are:', list(variants[~valid]))
+
+    data=np.empty((int(valid.sum()),3),dtype=object)
+    data[:,0]=variants[valid]
+    data[:,1]=list(X[valid])
+    data[:,2]=fitnesses[valid]
+    return data
+    
+def iter_data(fitnessKey:str, csvFile:str, encoder:object, chunksize=10000):
+    """
+    Description
+    -----------
+    Generator that reads 'csvFile' in chunks of 'chunksize' rows and yields the encoded chunks,
+    i.e. the memory consumption is bounded by the chunk size and not by the number of variants.
+
+    Parameters
+    ----------
+    fitnessKey : str
+        Name of column containing the fitness values.
+    csvFile : str
+        Name of the csv file containing variant names and associated fitness values.
+    encoder : object
+        Initialized 'Encode' or 'ParallelEncoder' class object.
+    chunksize : int
+        Number of rows read from 'csvFile' per chunk (default=10000).
 
-    manager=multiprocessing.Manager()
-    data=manager.list()
+    Returns
+    -------
+    Generator object yielding tuples (variants, X, fitnesses) of the valid variants of each chunk.
+    """
+    encode = encoder.encode if isinstance(encoder, ParallelEncoder) else encoder.encode_batch
 
-    processes=[]
-    for variants,fitnesses in zip(variants_split,fitnesses_split):
-        p=multiprocessing.Process(target=_get_data, args=[variants,fitnesses,dcaEncode,data])
-        p.start()
-        processes.append(p)
+    for df in pd.read_csv(csvFile,sep=';',comment='#',chunksize=chunksize):
+        fitnesses=df[fitnessKey].to_numpy()
+        variants=df['mutant'].to_numpy()
 
-    for p in processes:
-        p.join()
+        notNan=~np.isnan(fitnesses)
+        if not notNan.all():
+            print('NaNs are:', list(df.index[~notNan]))
+        fitnesses,variants=fitnesses[notNan],variants[notNan]
+
+        X,_,valid=encode(variants)
+        if not valid.all():
+            print('Rejected variants are:', list(variants[~valid]))
+
+        yield variants[valid],X[valid],fitnesses[valid]
+
+class CsvWriter:
+    """
+    Description
+    -----------
+    Output sink that appends encoded variants to a csv file with the columns
+    'variant', 'y', 'X0', ..., 'X{L-1}' (see 'generate_dataframe').
+
+    Attributes
+    ----------
+    csvFile : str
+        Name of the output csv-file.
+    """
+    def __init__(self, csvFile:str):
+        self.csvFile = csvFile
+        self._append = False
+
+    def write(self, variants:np.ndarray, X:np.ndarray, fitnesses:np.ndarray):
+        df = pd.DataFrame(X, columns=['X%d'%(i) for i in range(X.shape[1])])
+        df.insert(0, 'y', fitnesses)
+        df.insert(0, 'variant', variants)
+
+        if self._append:
+            df.to_csv(self.csvFile, sep=';', index=False, mode='a', header=False)
+
+        else:
+            df.to_csv(self.csvFile, sep=';', index=False)
+            self._append = True
+
+    def close(self):
+        pass
+
+def stream_data(fitnessKey:str, csvFile:str, dcaEncode:object, sink, chunksize=10000, nProcesses=6) -> int:
+    """
+    Description
+    -----------
+    Streaming counterpart of 'get_data' and 'generate_dataframe': reads 'csvFile' in chunks,
+    encodes each chunk in parallel, and writes the results incrementally to 'sink'.
+
+    Parameters
+    ----------
+    fitnessKey : str
+        Name of column containing the fitness values.
+    csvFile : str
+        Name of the csv file containing variant names and associated fitness values.
+    dcaEncode : object
+        Initialized 'Encode' class object.
+    sink : str or object
+        Name of the output csv-file (ending with '.csv'), name of an output directory for the
+        binary format (see 'NpyWriter'), or an object providing 'write(variants, X, fitnesses)' and 'close()'.
+    chunksize : int
+        Number of rows read from 'csvFile' per chunk (default=10000).
+    nProcesses : int
+        Number of processes to be used for parallel execution (default=6).
+
+    Returns
+    -------
+    nRows : int
+        Number of written variants.
+    """
+    if isinstance(sink, str):
+        sink = CsvWriter(sink) if sink.endswith('.csv') else NpyWriter(sink, dcaEncode.xWt)
+
+    nRows = 0
+    with ParallelEncoder(dcaEncode, nProcesses=nProcesses, chunkSize=max(1, min(1000, chunksize//max(1, nProcesses)))) as encoder:
+        for variants, X, fitnesses in iter_data(fitnessKey, csvFile, encoder, chunksize):
+            sink.write(variants, X, fitnesses)
+            nRows += variants.size
+    sink.close()
+    return nRows
 
-    return np.array(data,dtype=object)
-    
 def generate_dataframe(data:np.ndarray, csvFile:str, chunksize=100):
     """
     Description
@@ -299,27 +1169,7 @@ def generate_dataframe(data:np.ndarray, csvFile:str, chunksize=100):
     variants,X,fitnesses=np.array(data,dtype=object).T # Can cause error if data.size==0 ?!
     X=np.stack(X)
 
-    columns = ['variant', 'y']
-    [columns.append('X%d'%(i)) for i in range(X.shape[1])]
-
-    append = False
+    writer = CsvWriter(csvFile)
     for i in range(0,variants.size,chunksize):
-        variantsChunked = variants[i:i+chunksize]
-        fitnessesChunked = fitnesses[i:i+chunksize]
-        encodedSequences = X[i:i+chunksize]
-
-        df_data = []
-        for variant, fitness, encodedSequence in zip(variantsChunked, fitnessesChunked, encodedSequences):
-            df_row = [variant, fitness]
-            [df_row.append(xi) for xi in encodedSequence]
-            df_data.append(df_row)
-
-
-        df = pd.DataFrame(data = df_data, columns=columns)
-
-        if append:
-            df.to_csv(csvFile, sep=';', index=False, mode='a', header=False)
-
-        else:
-            df.to_csv(csvFile, sep=';', index=False)
-            append = True
+        writer.write(variants[i:i+chunksize], X[i:i+chunksize], fitnesses[i:i+chunksize])
+    writer.close()
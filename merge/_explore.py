@@ -4,8 +4,14 @@
 # affilation      Institute of Biotechnology, RWTH Aachen
 # email           a.illig@biotec.rwth-aachen.de
 
+import os
+import copy
+import heapq
 import random
-from ._utils import X_to_deltaE
+import tempfile
+import numpy as np
+from ._utils import X_to_deltaE, canonicalize_variant, save_pickle, load_pickle
+from ._encoding import _share_encode
 from math import exp
 from multiprocessing import Pool
 
@@ -40,9 +46,12 @@ class Explore:
     maxIter : int
         Number of iterations to perform (default = 10000).
 
+    predictionCache : object
+        Optional 'PredictionCache' memoizing the predicted fitness of variants scored by the walkers (default = None).
+
     """
 
-    def __init__(self, encodeCls:object, model:object, yWt:float, maxSubstitutions=3, sign=+1, factor=1.0, maxIter=1000):
+    def __init__(self, encodeCls:object, model:object, yWt:float, maxSubstitutions=3, sign=+1, factor=1.0, maxIter=1000, predictionCache=None):
         self.encodeCls = encodeCls
         self.model = model
         self.yWt = yWt
@@ -50,6 +59,8 @@ class Explore:
         self.sign = sign
         self.factor = factor
         self.maxIter = maxIter
+        self.predictionCache = predictionCache
+        self.nEvaluations = 0
 
 
     def _random_substitution(self) -> str:
@@ -108,6 +119,33 @@ class Explore:
             else:
                 return False
     
+    def _accept_substitutions(self, previous:np.ndarray, actual:np.ndarray, temperature:float, uniform:np.ndarray) -> np.ndarray:
+        """
+        Description
+        -----------
+        Vectorized counterpart of '_accept_substitution' for arrays of fitness values.
+
+        Parameters
+        ---------
+        previous : np.ndarray
+            Fitness values of the previous variants.
+
+        actual : np.ndarray
+            Fitness values of the new variants.
+
+        temperature : float or np.ndarray
+            Temperature(s) to choose.
+
+        uniform : np.ndarray
+            Uniform random numbers in [0, 1], one per variant.
+            
+        Returns
+        -------
+            Boolean array, True if the substitution should be introduced.
+        """
+        diff = self.sign*(actual - previous*self.factor)
+        return (diff > 0) | (uniform <= np.exp(np.minimum(diff/temperature, 0)))
+
     @staticmethod
     def _T(step:int, startingTemperature=1e-2, decay=5e-3) -> float:
         """
@@ -178,26 +216,382 @@ class Explore:
 
             variantTemp.append(substitution)    
 
-            xVariant = [self.encodeCls._encode_variant(','.join(variantTemp))]
-            deltaEVariant = X_to_deltaE(xVariant, self.encodeCls.xWt)
-            yActual = self.model.predict(xVariant, deltaEVariant)
+            yActual = self._predict_variant(','.join(variantTemp))
 
             if self._accept_substitution(yPrevious, yActual, temperature):
                 substitutions.append(substitution)
                 yPrevious = yActual
 
         if substitutions:
-            xVariant = [self.encodeCls._encode_variant(','.join(substitutions))]
-            deltaEVariant = X_to_deltaE(xVariant, self.encodeCls.xWt)
-            return (','.join(sorted(substitutions, key=lambda x:int(x[1:-1]))), self.model.predict(xVariant, deltaEVariant)[0])
+            return (','.join(sorted(substitutions, key=lambda x:int(x[1:-1]))), self._predict_variant(','.join(substitutions)))
         else:
             return ('WT', self.yWt)
 
-    def scrape_landscape(self, nWalkers, nCores=1) -> set:
+    def _predict_variant(self, variant:str) -> float:
+        """
+        Description
+        -----------
+        Predicts the fitness of 'variant', using 'predictionCache' if given.
+        """
+        if self.predictionCache is not None:
+            key = canonicalize_variant(variant)
+            fitness = self.predictionCache.get(key)
+            if fitness is not None:
+                return fitness
+
+        xVariant = [self.encodeCls._encode_variant(variant)]
+        deltaEVariant = X_to_deltaE(xVariant, self.encodeCls.xWt)
+        fitness = self.model.predict(xVariant, deltaEVariant)[0]
+        self.nEvaluations += 1
+
+        if self.predictionCache is not None:
+            self.predictionCache.put(key, fitness)
+        return fitness
+
+    def _predict_sequences(self, sequences:np.ndarray, batchSize=10000) -> np.ndarray:
+        """
+        Description
+        -----------
+        Predicts the fitness of integer-coded sequences (see 'Encode.targetIndices') with at most
+        'maxSubstitutions' substitutions in vectorized batches.
+        """
+        wt = self.encodeCls.targetIndices
+        fitnesses = np.zeros(sequences.shape[0])
+        for start in range(0, sequences.shape[0], batchSize):
+            chunk = sequences[start:start+batchSize]
+            substituted = chunk != wt
+            k = max(1, int(substituted.sum(axis=1).max(initial=0)))
+            positions = np.argsort(~substituted, axis=1, kind='stable')[:,:k]
+            rows = np.arange(chunk.shape[0])[:,None]
+            X = self.encodeCls._encode_mutations(positions, chunk[rows,positions], substituted[rows,positions])
+            fitnesses[start:start+batchSize] = self.model.predict(X, X_to_deltaE(X, self.encodeCls.xWt))
+        self.nEvaluations += sequences.shape[0]
+        return fitnesses
+
+    def _variant_name(self, sequence:np.ndarray) -> str:
+        """
+        Description
+        -----------
+        Returns the name of the integer-coded sequence ('WT' if not substituted).
+        """
+        sites = np.flatnonzero(sequence != self.encodeCls.targetIndices)
+        substitutions = [self.encodeCls._substitution_name(i, sequence[i]) for i in sites]
+        return ','.join(substitutions) if substitutions else 'WT'
+
+    def _propose(self, sequences:np.ndarray, rng:np.random.Generator) -> tuple:
+        """
+        Description
+        -----------
+        Proposes one random substitution per sequence (see '_random_substitution'). Substitutions at a
+        position that is already substituted replace the previous substitution.
+
+        Returns
+        -------
+        proposals : np.ndarray
+            Integer-coded proposed sequences.
+        valid : np.ndarray
+            Boolean array, False for proposals introducing the wild type, the present, or an invalid amino acid.
+        """
+        walkers = np.arange(sequences.shape[0])
+        sites = rng.integers(0, self.encodeCls.L, walkers.size)
+        aminoAcids = rng.integers(0, self.encodeCls.q, walkers.size)
+        valid = self._substitutable[sites, aminoAcids] & (aminoAcids != sequences[walkers, sites])
+
+        proposals = sequences.copy()
+        proposals[walkers, sites] = aminoAcids
+        return proposals, valid
+
+    @property
+    def _substitutable(self) -> np.ndarray:
+        if getattr(self, '_substitutableCache', None) is None:
+            self._substitutableCache = self.encodeCls._substitutable()
+        return self._substitutableCache
+
+    def _collect(self, sequences:np.ndarray, fitnesses:np.ndarray) -> list:
+        """
+        Description
+        -----------
+        Returns the unique improved variants as list of tuples (variant, fitness) sorted from best to worst.
+        """
+        results = {}
+        for sequence, fitness in zip(sequences, fitnesses):
+            if self.sign*fitness > self.sign*self.yWt:
+                results[self._variant_name(sequence)] = fitness
+        return sorted(results.items(), key=lambda x:self.sign*x[1], reverse=True)
+
+    def anneal(self, nWalkers:int, seed=0, batchSize=10000) -> list:
+        """
+        Description
+        -----------
+        Population-based counterpart of 'scrape_landscape': advances 'nWalkers' walkers in lockstep as
+        integer-coded sequences. In each iteration, all active walkers propose a substitution, the proposals
+        are encoded and predicted in vectorized batches, and accepted according to the Metropolis criterion
+        (see '_accept_substitution') at temperature '_T(iteration)'. A walker stops after 'maxSubstitutions'
+        substitutions or 'maxIter' iterations.
+
+        Parameters
+        ---------
+        nWalkers : int
+            Number of random walkers to create to scrape the fitness landscape.
+
+        seed : int
+            Seed of the random generator (default = 0).
+
+        batchSize : int
+            Number of variants encoded and predicted per vectorized pass (default = 10000).
+
+        Returns
+        -------
+            List of tuples including improved variants and their (predicted) fitness values, sorted from best to worst.
+        """
+        rng = np.random.default_rng(seed)
+        wt = self.encodeCls.targetIndices
+        sequences = np.tile(wt, (nWalkers, 1))
+        fitnesses = np.full(nWalkers, float(self.yWt))
+
+        for iteration in range(self.maxIter):
+            active = np.flatnonzero(np.sum(sequences != wt, axis=1) < self.maxSubstitutions)
+            if active.size == 0:
+                break
+
+            proposals, valid = self._propose(sequences[active], rng)
+            uniform = rng.random(active.size)
+            active, proposals, uniform = active[valid], proposals[valid], uniform[valid]
+
+            actual = self._predict_sequences(proposals, batchSize)
+            accept = self._accept_substitutions(fitnesses[active], actual, self._T(iteration), uniform)
+            sequences[active[accept]] = proposals[accept]
+            fitnesses[active[accept]] = actual[accept]
+
+        return self._collect(sequences, fitnesses)
+
+    def _limit_substitutions(self, proposals:np.ndarray, sequences:np.ndarray, rng:np.random.Generator) -> np.ndarray:
+        """
+        Description
+        -----------
+        Reverts a random previous substitution of proposals exceeding 'maxSubstitutions', i.e. at the limit
+        a proposal at a new position swaps one substitution for another.
+        """
+        wt = self.encodeCls.targetIndices
+        exceeding = np.flatnonzero(np.sum(proposals != wt, axis=1) > self.maxSubstitutions)
+        if exceeding.size:
+            previous = (sequences[exceeding] != wt) & (proposals[exceeding] == sequences[exceeding])
+            sites = np.argmax(rng.random(previous.shape)*previous, axis=1)
+            proposals[exceeding, sites] = wt[sites]
+        return proposals
+
+    def replica_exchange(self, nLadders:int, temperatures=None, nSteps=None, swapInterval=10, seed=0, batchSize=10000) -> list:
+        """
+        Description
+        -----------
+        Parallel tempering: 'nLadders' independent ladders of chains at fixed 'temperatures' are advanced in lockstep
+        using the proposals of 'anneal' and the Metropolis criterion. Every 'swapInterval' steps, neighbouring chains
+        of a ladder exchange their states with probability min(1, exp(sign*(y_j-y_i)*(1/T_i-1/T_j))), so that states
+        found at high temperatures can be refined at low temperatures. Chains at 'maxSubstitutions' swap one of their
+        substitutions for the proposed one. All accepted improved variants are collected.
+
+        Parameters
+        ---------
+        nLadders : int
+            Number of independent temperature ladders.
+
+        temperatures : list
+            Temperatures of the chains of a ladder (default = None, i.e. 8 temperatures spaced geometrically
+            between _T(0) and _T(maxIter)).
+
+        nSteps : int
+            Number of steps (default = None, i.e. maxIter).
+
+        swapInterval : int
+            Number of steps between exchange attempts (default = 10).
+
+        seed : int
+            Seed of the random generator (default = 0).
+
+        batchSize : int
+            Number of variants encoded and predicted per vectorized pass (default = 10000).
+
+        Returns
+        -------
+            List of tuples including improved variants and their (predicted) fitness values, sorted from best to worst.
+        """
+        if temperatures is None:
+            temperatures = np.geomspace(self._T(0), self._T(self.maxIter), 8)
+        temperatures = np.asarray(temperatures, dtype=float)
+        nSteps = self.maxIter if nSteps is None else nSteps
+
+        rng = np.random.default_rng(seed)
+        nChains = nLadders*temperatures.size
+        chainTemperatures = np.tile(temperatures, nLadders)
+        sequences = np.tile(self.encodeCls.targetIndices, (nChains, 1))
+        fitnesses = np.full(nChains, float(self.yWt))
+        results = {}
+
+        for step in range(nSteps):
+            proposals, valid = self._propose(sequences, rng)
+            proposals = self._limit_substitutions(proposals, sequences, rng)
+            uniform = rng.random(nChains)
+            chains = np.flatnonzero(valid)
+
+            actual = self._predict_sequences(proposals[chains], batchSize)
+            accept = self._accept_substitutions(fitnesses[chains], actual, chainTemperatures[chains], uniform[chains])
+            chains = chains[accept]
+            sequences[chains] = proposals[chains]
+            fitnesses[chains] = actual[accept]
+
+            for chain in chains[self.sign*fitnesses[chains] > self.sign*self.yWt]:
+                results[self._variant_name(sequences[chain])] = fitnesses[chain]
+
+            if (step+1) % swapInterval == 0 and temperatures.size > 1:
+                offset = (step//swapInterval) % 2
+                i = np.arange(offset, temperatures.size-1, 2)
+                i = (i[None,:] + temperatures.size*np.arange(nLadders)[:,None]).ravel()
+                j = i + 1
+                exponent = self.sign*(fitnesses[j] - fitnesses[i])*(1/chainTemperatures[i] - 1/chainTemperatures[j])
+                swap = rng.random(i.size) <= np.exp(np.minimum(exponent, 0))
+                i, j = i[swap], j[swap]
+                sequences[i], sequences[j] = sequences[j].copy(), sequences[i].copy()
+                fitnesses[i], fitnesses[j] = fitnesses[j].copy(), fitnesses[i].copy()
+
+        return sorted(results.items(), key=lambda x:self.sign*x[1], reverse=True)
+
+    def _truncate_substitutions(self, sequences:np.ndarray, rng:np.random.Generator) -> np.ndarray:
+        """
+        Description
+        -----------
+        Reverts randomly chosen substitutions of sequences exceeding 'maxSubstitutions' to the wild type,
+        so that exactly 'maxSubstitutions' substitutions remain.
+        """
+        wt = self.encodeCls.targetIndices
+        substituted = sequences != wt
+        exceeding = np.flatnonzero(substituted.sum(axis=1) > self.maxSubstitutions)
+        if exceeding.size:
+            keys = np.where(substituted[exceeding], rng.random((exceeding.size, wt.size)), np.inf)
+            ranks = np.argsort(np.argsort(keys, axis=1), axis=1)
+            revert = substituted[exceeding] & (ranks >= self.maxSubstitutions)
+            sequences[exceeding] = np.where(revert, wt, sequences[exceeding])
+        return sequences
+
+    def _tournament(self, fitnesses:np.ndarray, nSelections:int, tournamentSize:int, rng:np.random.Generator) -> np.ndarray:
+        """
+        Description
+        -----------
+        Tournament selection: returns the indices of the best (according to 'sign') of 'tournamentSize'
+        randomly drawn individuals for each of the 'nSelections' selections.
+        """
+        candidates = rng.integers(0, fitnesses.size, (nSelections, tournamentSize))
+        return candidates[np.arange(nSelections), np.argmax(self.sign*fitnesses[candidates], axis=1)]
+
+    def evolve(self, populationSize:int, nGenerations=None, crossoverRate=0.5, mutationRate=0.5, tournamentSize=3, eliteSize=1, seed=0, batchSize=10000) -> list:
+        """
+        Description
+        -----------
+        Genetic algorithm on integer-coded sequences. In each generation, parents are chosen by tournament
+        selection, recombined by uniform crossover of their substitutions with probability 'crossoverRate',
+        and mutated by a random substitution (see '_propose') with probability 'mutationRate'. Offspring exceeding
+        'maxSubstitutions' keep a random subset of their substitutions. The offspring of a generation are
+        encoded and predicted in vectorized batches; the 'eliteSize' best individuals are kept unchanged.
+        All improved variants found are collected.
+
+        Parameters
+        ---------
+        populationSize : int
+            Number of individuals per generation.
+
+        nGenerations : int
+            Number of generations (default = None, i.e. maxIter).
+
+        crossoverRate : float
+            Probability of recombining two parents (default = 0.5).
+
+        mutationRate : float
+            Probability of introducing a random substitution into an offspring (default = 0.5).
+
+        tournamentSize : int
+            Number of individuals competing per selection (default = 3).
+
+        eliteSize : int
+            Number of best individuals transferred unchanged to the next generation (default = 1).
+
+        seed : int
+            Seed of the random generator (default = 0).
+
+        batchSize : int
+            Number of variants encoded and predicted per vectorized pass (default = 10000).
+
+        Returns
+        -------
+            List of tuples including improved variants and their (predicted) fitness values, sorted from best to worst.
+        """
+        nGenerations = self.maxIter if nGenerations is None else nGenerations
+        eliteSize = min(eliteSize, populationSize)
+
+        rng = np.random.default_rng(seed)
+        wt = self.encodeCls.targetIndices
+        population, valid = self._propose(np.tile(wt, (populationSize, 1)), rng)
+        population[~valid] = wt
+        population = self._truncate_substitutions(population, rng)
+        fitnesses = self._predict_sequences(population, batchSize)
+        results = {}
+
+        for generation in range(nGenerations):
+            for sequence, fitness in zip(population, fitnesses):
+                if self.sign*fitness > self.sign*self.yWt:
+                    results[self._variant_name(sequence)] = fitness
+
+            nOffspring = populationSize - eliteSize
+            parents = self._tournament(fitnesses, 2*nOffspring, tournamentSize, rng).reshape(2, nOffspring)
+            offspring = population[parents[0]].copy()
+
+            recombine = rng.random(nOffspring) < crossoverRate
+            fromSecond = recombine[:,None] & (rng.random(offspring.shape) < 0.5)
+            offspring = np.where(fromSecond, population[parents[1]], offspring)
+
+            mutate = np.flatnonzero(rng.random(nOffspring) < mutationRate)
+            proposals, valid = self._propose(offspring[mutate], rng)
+            offspring[mutate[valid]] = proposals[valid]
+            offspring = self._truncate_substitutions(offspring, rng)
+
+            elite = np.argsort(-self.sign*fitnesses, kind='stable')[:eliteSize]
+            population = np.concatenate([population[elite], offspring])
+            fitnesses = np.concatenate([fitnesses[elite], self._predict_sequences(offspring, batchSize)])
+
+        for sequence, fitness in zip(population, fitnesses):
+            if self.sign*fitness > self.sign*self.yWt:
+                results[self._variant_name(sequence)] = fitness
+
+        return sorted(results.items(), key=lambda x:self.sign*x[1], reverse=True)
+
+    def _add_result(self, results:dict, heap:list, variant:str, fitness:float, topK):
+        """
+        Description
+        -----------
+        Adds an improved variant to the 'results' deduplicated by canonicalized variant and keeps only
+        the best 'topK' entries ('heap' is a min-heap of (sign*fitness, variant), only used if 'topK' is given).
+        """
+        if not self.sign*fitness > self.sign*self.yWt:
+            return
+
+        variant = canonicalize_variant(variant)
+        if variant in results:
+            return
+
+        results[variant] = fitness
+        if topK is None:
+            return
+        heapq.heappush(heap, (self.sign*fitness, variant))
+        if len(heap) > topK:
+            _, worst = heapq.heappop(heap)
+            del results[worst]
+
+    def scrape_landscape(self, nWalkers, nCores=1, topK=None, checkpointFile=None, checkpointInterval=1000) -> list:
         """
         Description
         -----------
         Function to scrape the fitness landscape for improved variants using 'nWalkers'.
+        Results are streamed from the workers, deduplicated by variant, and optionally reduced to the best 'topK'.
+        If 'checkpointFile' is given, the progress is saved every 'checkpointInterval' walkers and an interrupted
+        run with the same 'nWalkers' is resumed from it.
 
         Parameters
         ---------
@@ -207,17 +601,142 @@ class Explore:
         nCores : int
             Number of cores used for parallelization (default = 1).
 
+        topK : int
+            Number of best variants to keep (default = None, i.e. all improved variants).
+
+        checkpointFile : str
+            Name of the pkl file to save the progress to and resume from (default = None).
+
+        checkpointInterval : int
+            Number of finished walkers between checkpoints (default = 1000).
+
         Returns
         -------
-            Set including tuples of improved variants and their (predicted) fitness values.
+            List of tuples including improved variants and their (predicted) fitness values, sorted from best to worst.
         """
-        seeds = range(nWalkers)
-        pool = Pool(nCores)
+        done = np.zeros(nWalkers, dtype=bool)
+        results, heap = {}, []
+        if checkpointFile is not None and os.path.exists(checkpointFile):
+            checkpoint = load_pickle(checkpointFile)
+            if checkpoint['done'].size == nWalkers:
+                done, results = checkpoint['done'], checkpoint['results']
+                if topK is not None:
+                    heap = [(self.sign*fitness, variant) for variant, fitness in results.items()]
+                    heapq.heapify(heap)
+
+        def save_checkpoint():
+            save_pickle(checkpointFile + '.tmp', {'done':done, 'results':results})
+            os.replace(checkpointFile + '.tmp', checkpointFile)
+
+        seeds = np.flatnonzero(~done).tolist()
+        with ExploreExecutor(self, nCores) as executor:
+            for n, (seed, variant, fitness) in enumerate(executor.map(seeds), start=1):
+                self._add_result(results, heap, variant, fitness, topK)
+                done[seed] = True
+                if checkpointFile is not None and n % checkpointInterval == 0:
+                    save_checkpoint()
+
+        if checkpointFile is not None:
+            save_checkpoint()
+
+        return sorted(results.items(), key=lambda x:self.sign*x[1], reverse=True)
+
+_worker = {}
+
+def _init_worker(explore:Explore):
+    """
+    Description
+    -----------
+    Pool initializer, stores the shared 'Explore' object once per worker process.
+    """
+    _worker['explore'] = explore
+
+def _caches(explore:Explore) -> list:
+    # caches whose counters are collected from the workers: prediction cache and encoding cache
+    return [explore.predictionCache, getattr(explore.encodeCls, 'cache', None)]
 
-        results = set()
-        variants, fitnesses = zip(*pool.map(self._random_walker, seeds))
-        for variant, fitness in zip(variants, fitnesses):
-            if fitness > self.sign*self.yWt:
-                results.add((variant, round(fitness, ndigits=2)))
+def _scrape_walker(seed:int) -> tuple:
+    """
+    Description
+    -----------
+    Runs the walker 'seed' and returns (seed, variant, fitness, counters) with 'counters' being the
+    (hits, misses) of the walker for each cache in '_caches'. Buffered entries of the encoding cache
+    are written after each walker, as the workers exit without finalization.
+    """
+    explore = _worker['explore']
+    caches = _caches(explore)
+    before = [(cache.hits, cache.misses) if cache is not None else (0, 0) for cache in caches]
+    variant, fitness = explore._random_walker(seed)
+    if caches[1] is not None:
+        caches[1].flush()
+    counters = [(cache.hits - hits, cache.misses - misses) if cache is not None else (0, 0)
+                for cache, (hits, misses) in zip(caches, before)]
+    return (seed, variant, fitness, counters)
+
+class ExploreExecutor:
+    """
+    Description
+    -----------
+    Runs random walkers of an 'Explore' instance in a pool of worker processes. Each worker receives the
+    'Explore' instance (including the trained model) once through the pool initializer; the coupling blocks
+    of 'encodeCls' are shared read-only via a memory-mapped file instead of being pickled.
+    Use as context manager or call 'close' to shut down the pool and remove the temporary files.
 
-        return sorted(results, key=lambda x:x[1], reverse=True)
+    Attributes
+    ----------
+    explore : object
+        Initialized 'Explore' class.
+    nCores : int
+        Number of cores used for parallelization (default = 1, i.e. walkers run in the calling process).
+    """
+    def __init__(self, explore:Explore, nCores=1):
+        self.explore = explore
+        self.nCores = nCores
+        self.pool = None
+        self._directory = None
+        if nCores > 1:
+            cache = getattr(explore.encodeCls, 'cache', None)
+            if cache is not None: # workers see the entries of the parent, the forked connection is reset in the workers
+                cache.flush()
+            self._directory = tempfile.TemporaryDirectory()
+            shared = copy.copy(explore)
+            shared.encodeCls = _share_encode(explore.encodeCls, self._directory.name)
+            self.pool = Pool(nCores, initializer=_init_worker, initargs=(shared,))
+
+    def map(self, seeds:list):
+        """
+        Description
+        -----------
+        Generator yielding (seed, variant, fitness) of the walkers in order of completion.
+        """
+        if self.pool is None:
+            for seed in seeds:
+                yield (seed, *self.explore._random_walker(seed))
+            return
+
+        caches = _caches(self.explore)
+        chunksize = max(1, min(100, len(seeds)//(4*self.nCores)))
+        for seed, variant, fitness, counters in self.pool.imap_unordered(_scrape_walker, seeds, chunksize=chunksize):
+            for cache, (hits, misses) in zip(caches, counters): # collect the counters of the workers
+                if cache is not None:
+                    cache.hits += hits
+                    cache.misses += misses
+            yield (seed, variant, fitness)
+
+    def close(self):
+        cache = getattr(self.explore.encodeCls, 'cache', None)
+        if cache is not None:
+            cache.flush()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self._directory is not None:
+            self._directory.cleanup()
+            self._directory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
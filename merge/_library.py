@@ -0,0 +1,165 @@
+# version         v0.1.7
+# date            30.01.2024
+# author          Alexander-Maurice Illig
+# affilation      Institute of Biotechnology, RWTH Aachen
+# email           a.illig@biotec.rwth-aachen.de
+
+import tempfile
+import numpy as np
+from multiprocessing import Pool
+
+from ._encoding import _share_encode
+from ._utils import X_to_deltaE
+
+def _select_top(scores:np.ndarray, indices:np.ndarray, k:int) -> tuple:
+    """
+    Description
+    -----------
+    Returns the 'k' highest scores and their library indices. Ties are broken by the lower index,
+    i.e. the selection does not depend on the order of evaluation.
+    """
+    order = np.lexsort((indices, -scores))[:k]
+    return scores[order], indices[order]
+
+class Library:
+    """
+    Description
+    -----------
+    Combinatorial library defined by the allowed amino acids per position. The library comprises
+    all members of the Cartesian product of the allowed amino acids; allowing the wild type amino acid
+    at a position includes the members not substituted at this position.
+    Members are addressed by their index in [0, size) and decoded batch-wise, i.e. the library
+    is never held in memory.
+
+    Attributes
+    ----------
+    encodeCls : object
+        Initialized 'Encode' class.
+    allowed : dict
+        Position (numbering of the variants) -> iterable of allowed amino acids in one letter code,
+        e.g. {173: 'LFW', 180: ['A', 'S']}.
+    """
+    def __init__(self, encodeCls:object, allowed:dict):
+        self.encodeCls = encodeCls
+        self.positions = sorted(allowed)
+        self.sites = encodeCls._site_indices(self.positions)
+        self.choices = [np.array([encodeCls.alphabet2index[a] for a in dict.fromkeys(allowed[position])], dtype=int)
+                        for position in self.positions]
+        self.shape = tuple(choices.size for choices in self.choices)
+        self.size = int(np.prod(self.shape, dtype=object))
+
+    def decode(self, indices:np.ndarray) -> tuple:
+        """
+        Description
+        -----------
+        Converts library indices into an integer mutation tensor (see 'Encode._encode_mutations').
+
+        Returns
+        -------
+        positions : np.ndarray
+            Internal site indices of shape (N, P).
+        aminoAcids : np.ndarray
+            Indices of the introduced amino acids of shape (N, P).
+        mask : np.ndarray
+            Boolean array of shape (N, P), False where the wild type amino acid is kept.
+        """
+        digits = np.unravel_index(indices, self.shape)
+        aminoAcids = np.stack([choices[digit] for choices, digit in zip(self.choices, digits)], axis=1)
+        positions = np.broadcast_to(self.sites, aminoAcids.shape)
+        mask = aminoAcids != self.encodeCls.targetIndices[self.sites]
+        return positions, aminoAcids, mask
+
+    def variant(self, index:int) -> str:
+        """
+        Description
+        -----------
+        Returns the name of the library member 'index' ('WT' if no position is substituted).
+        """
+        _, aminoAcids, mask = self.decode(np.array([index]))
+        substitutions = [self.encodeCls._substitution_name(i, a) for i, a, m in zip(self.sites, aminoAcids[0], mask[0]) if m]
+        return ','.join(substitutions) if substitutions else 'WT'
+
+    def score(self, start:int, stop:int, model=None) -> np.ndarray:
+        """
+        Description
+        -----------
+        Scores the members [start, stop) with 'model' (e.g. 'CombinedPredictor') or by deltaE if 'model' is None.
+        """
+        positions, aminoAcids, mask = self.decode(np.arange(start, stop, dtype=np.int64))
+        if model is None:
+            return self.encodeCls._delta_energy_mutations(positions, aminoAcids, mask)
+
+        X = self.encodeCls._encode_mutations(positions, aminoAcids, mask)
+        return np.asarray(model.predict(X, X_to_deltaE(X, self.encodeCls.xWt)), dtype=float)
+
+    def top(self, start:int, stop:int, k:int, model=None, sign=+1, batchSize=10000) -> tuple:
+        """
+        Description
+        -----------
+        Returns the 'k' best scores (multiplied by 'sign') and indices of the members [start, stop).
+        """
+        bestScores, bestIndices = np.zeros(0), np.zeros(0, dtype=np.int64)
+        for batchStart in range(start, stop, batchSize):
+            batchStop = min(batchStart+batchSize, stop)
+            scores = np.concatenate([bestScores, sign*self.score(batchStart, batchStop, model)])
+            indices = np.concatenate([bestIndices, np.arange(batchStart, batchStop, dtype=np.int64)])
+            bestScores, bestIndices = _select_top(scores, indices, k)
+        return bestScores, bestIndices
+
+_worker = {}
+
+def _init_worker(library:Library, model):
+    _worker['library'] = library
+    _worker['model'] = model
+
+def _top_range(task:tuple) -> tuple:
+    start, stop, k, sign, batchSize = task
+    return _worker['library'].top(start, stop, k, _worker['model'], sign, batchSize)
+
+def score_library(encodeCls:object, allowed:dict, model=None, k=100, sign=+1, batchSize=10000, nProcesses=1, taskSize=1000000) -> list:
+    """
+    Description
+    -----------
+    Scores all members of a combinatorial library (see 'Library') in vectorized batches and
+    returns the 'k' best members. Only the current top 'k' are kept, i.e. the memory consumption
+    does not depend on the library size. With nProcesses > 1, ranges of 'taskSize' members are
+    distributed to worker processes that share the coupling blocks via a memory-mapped file.
+
+    Parameters
+    ----------
+    encodeCls : object
+        Initialized 'Encode' class.
+    allowed : dict
+        Position (numbering of the variants) -> iterable of allowed amino acids in one letter code.
+    model : object
+        Initialized and trained 'CombinedPredictor' class; if None, members are ranked by deltaE (default = None).
+    k : int
+        Number of members to return (default = 100).
+    sign : int
+        Either +1 for maxima or -1 for minima (default = +1).
+    batchSize : int
+        Number of members encoded and scored per vectorized pass (default = 10000).
+    nProcesses : int
+        Number of processes to be used for parallel execution (default = 1).
+    taskSize : int
+        Number of members per task if nProcesses > 1 (default = 1000000).
+
+    Returns
+    -------
+        List of tuples (variant, score) sorted from best to worst.
+    """
+    library = Library(encodeCls, allowed)
+
+    if nProcesses > 1:
+        with tempfile.TemporaryDirectory() as directory:
+            library.encodeCls = _share_encode(encodeCls, directory)
+            tasks = ((start, min(start+taskSize, library.size), k, sign, batchSize) for start in range(0, library.size, taskSize))
+            bestScores, bestIndices = np.zeros(0), np.zeros(0, dtype=np.int64)
+            with Pool(nProcesses, initializer=_init_worker, initargs=(library, model)) as pool:
+                for scores, indices in pool.imap_unordered(_top_range, tasks):
+                    bestScores, bestIndices = _select_top(np.concatenate([bestScores, scores]), np.concatenate([bestIndices, indices]), k)
+            library.encodeCls = encodeCls
+    else:
+        bestScores, bestIndices = library.top(0, library.size, k, model, sign, batchSize)
+
+    return [(library.variant(index), sign*score) for score, index in zip(bestScores, bestIndices)]
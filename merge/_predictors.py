@@ -5,61 +5,217 @@
 # email           a.illig@biotec.rwth-aachen.de
 
 import numpy as np
-from scipy.optimize import curve_fit
+from scipy.optimize import curve_fit, least_squares
+from scipy.special import expit
 class PredictorDCA:
     def __init__(self, maxfev=10000, p0=(1,1,-7,1),
-                 bounds=[(-5, -5, -20, -20), (5, 5, 0, 20)]):
+                 bounds=[(-5, -5, -20, -20), (5, 5, 0, 20)], warmStart=False):
         self.maxfev = maxfev
         self.p0 = p0
         self.bounds = bounds
+        self.warmStart = warmStart
         
     @staticmethod
     def logistic(deltaE, *args):
         return args[0] / (1 + np.exp(-args[1]*(deltaE-args[2]))) + args[3]
+
+    @staticmethod
+    def jacobian(deltaE, *args):
+        # analytic derivatives of 'logistic' with respect to its four parameters, shape (n, 4)
+        s = expit(args[1]*(deltaE-args[2]))
+        ds = args[0]*s*(1-s)
+        return np.column_stack([s, ds*(deltaE-args[2]), -ds*args[1], np.ones_like(s)])
+
+    def _initial_params(self, p0=None):
+        # explicit 'p0' > previous solution (if warmStart) > default 'p0', clipped to the bounds
+        if p0 is None:
+            p0 = self.params if self.warmStart and hasattr(self, 'params') else self.p0
+        return np.clip(np.asarray(p0, dtype=float), *np.asarray(self.bounds, dtype=float))
     
-    def fit(self, deltaE, y):
-        self.params, self.cov = curve_fit(self.logistic, deltaE, y, maxfev=self.maxfev, p0=self.p0, bounds=self.bounds)
+    def fit(self, deltaE, y, p0=None):
+        self.params, self.cov, info, _, _ = curve_fit(self.logistic, deltaE, y, maxfev=self.maxfev, p0=self._initial_params(p0),
+                                                      bounds=self.bounds, jac=self.jacobian, full_output=True)
+        self.nfev = info['nfev']
         return self
+
+    def fit_folds(self, deltaE, y, folds, p0=None):
+        # fits the training rows of all 'folds' as one batched least squares problem with a
+        # block-diagonal Jacobian; returns one fitted 'PredictorDCA' per fold
+        nFolds = len(folds)
+        start = np.tile(self._initial_params(p0), nFolds)
+        lower, upper = (np.tile(bound, nFolds) for bound in np.asarray(self.bounds, dtype=float))
+        rows = [trainingIdxs for trainingIdxs,_ in folds]
+        offsets = np.cumsum([0] + [r.size for r in rows])
+
+        def residuals(params):
+            return np.concatenate([self.logistic(deltaE[r], *params[4*k:4*k+4]) - y[r] for k, r in enumerate(rows)])
+
+        def jacobian(params):
+            jac = np.zeros((offsets[-1], params.size))
+            for k, r in enumerate(rows):
+                jac[offsets[k]:offsets[k+1], 4*k:4*k+4] = self.jacobian(deltaE[r], *params[4*k:4*k+4])
+            return jac
+
+        solution = least_squares(residuals, start, jac=jacobian, bounds=(lower, upper), method='trf', max_nfev=self.maxfev)
+        predictors = []
+        for k in range(nFolds):
+            predictor = PredictorDCA(self.maxfev, self.p0, self.bounds, self.warmStart)
+            predictor.params, predictor.nfev = solution.x[4*k:4*k+4], solution.nfev
+            predictors.append(predictor)
+        return predictors
     
     def predict(self, deltaE):
         return self.logistic(deltaE, *self.params)
     
     
-from sklearn.linear_model import RidgeCV
+from sklearn.linear_model import RidgeCV, Ridge
+from sklearn.model_selection import KFold
+def _ridge_path(x, y, alphas, fitIntercept=True):
+    # coefficients (nFeatures, nAlphas) and intercepts (nAlphas,) for all 'alphas' from a single
+    # eigendecomposition of the (centered) Gram matrix: w = Q diag(1/(lambda+alpha)) Q^T X^T y
+    xMean = x.mean(axis=0) if fitIntercept else np.zeros(x.shape[1])
+    yMean = y.mean() if fitIntercept else 0.0
+    xc = x - xMean
+    return _ridge_solve(xc.T @ xc, xc.T @ (y - yMean), xMean, yMean, alphas)
+
+def _ridge_solve(gram, xty, xMean, yMean, alphas):
+    eigenvalues, Q = np.linalg.eigh(gram)
+    projection = Q.T @ xty
+    coefs = Q @ (projection[:,None] / (eigenvalues[:,None] + alphas[None,:]))
+    return coefs, yMean - xMean @ coefs
+
+class _RidgeStatistics:
+    # sufficient statistics (n, sum x, sum y, X^T X, X^T y, y^T y) of the ridge problem per block of rows;
+    # ridge paths and validation scores of held-out blocks are computed from them without the rows
+    def __init__(self, nBlocks, nFeatures):
+        self.n = np.zeros(nBlocks)
+        self.xSum = np.zeros((nBlocks, nFeatures))
+        self.ySum = np.zeros(nBlocks)
+        self.xtx = np.zeros((nBlocks, nFeatures, nFeatures))
+        self.xty = np.zeros((nBlocks, nFeatures))
+        self.yty = np.zeros(nBlocks)
+
+    def add(self, x, y, blocks):
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        for block in np.unique(blocks):
+            xb, yb = x[blocks == block], y[blocks == block]
+            self.n[block] += yb.size
+            self.xSum[block] += xb.sum(axis=0)
+            self.ySum[block] += yb.sum()
+            self.xtx[block] += xb.T @ xb
+            self.xty[block] += xb.T @ yb
+            self.yty[block] += yb @ yb
+
+    def path(self, alphas, fitIntercept=True, heldOut=None):
+        # ridge path fitted on all blocks except 'heldOut'
+        keep = np.arange(self.n.size) != heldOut
+        n, xSum, ySum = self.n[keep].sum(), self.xSum[keep].sum(axis=0), self.ySum[keep].sum()
+        gram, xty = self.xtx[keep].sum(axis=0), self.xty[keep].sum(axis=0)
+        if not fitIntercept:
+            return _ridge_solve(gram, xty, np.zeros(xSum.size), 0.0, alphas)
+        xMean, yMean = xSum/n, ySum/n
+        return _ridge_solve(gram - n*np.outer(xMean, xMean), xty - n*xMean*yMean, xMean, yMean, alphas)
+
+    def r2_scores(self, block, coefs, intercepts):
+        # R2 of the models (coefs, intercepts) on the rows of 'block'
+        n, ySum, yty = self.n[block], self.ySum[block], self.yty[block]
+        ssRes = (yty - 2*coefs.T @ self.xty[block] - 2*intercepts*ySum + np.sum(coefs*(self.xtx[block] @ coefs), axis=0)
+                 + 2*intercepts*(coefs.T @ self.xSum[block]) + n*intercepts**2)
+        ssTot = yty - ySum**2/n
+        if ssTot <= 0:
+            return np.where(ssRes <= 0, 1.0, 0.0)
+        return 1 - ssRes/ssTot
+
+class _RidgeModel:
+    # linear model with given coefficients, replaces the fitted sklearn model of 'PredictorRidge' after updates
+    def __init__(self, coef, intercept, alpha):
+        self.coef_ = coef
+        self.intercept_ = intercept
+        self.alpha = alpha
+
+    def predict(self, x):
+        return np.asarray(x, dtype=float) @ self.coef_ + self.intercept_
+
+def _r2_scores(yTrue, yPred):
+    # column-wise counterpart of 'sklearn.metrics.r2_score' for predictions of shape (nSamples, nAlphas)
+    ssRes = np.sum(np.square(yTrue[:,None] - yPred), axis=0)
+    ssTot = np.sum(np.square(yTrue - yTrue.mean()))
+    if ssTot == 0:
+        return np.where(ssRes == 0, 1.0, 0.0)
+    return 1 - ssRes/ssTot
+
 class PredictorRidge:
     def __init__(self, alphas=np.logspace(-6,6,100),
-                 fitIntercept=True, cv=5):
+                 fitIntercept=True, cv=5, solver='eigen'):
         self.alphas = alphas
         self.fitIntercept = fitIntercept
         self.cv = cv       
+        self.solver = solver
     
     def fit(self, x, y):
-        self.predictor = RidgeCV(alphas=self.alphas, fit_intercept=self.fitIntercept, cv=self.cv).fit(x, y)
+        # 'eigen': evaluates the whole alpha grid per fold from one eigendecomposition, selecting alpha
+        #          like RidgeCV (unshuffled KFold, mean R2, first best alpha) and refitting with Ridge
+        # 'sklearn': RidgeCV
+        if self.solver == 'sklearn' or not isinstance(self.cv, (int, np.integer)):
+            self.predictor = RidgeCV(alphas=self.alphas, fit_intercept=self.fitIntercept, cv=self.cv).fit(x, y)
+            return self
+        elif self.solver != 'eigen':
+            raise ValueError("solver must be either 'eigen' or 'sklearn', got %r"%(self.solver))
+
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        alphas = np.asarray(self.alphas, dtype=float)
+        scores = np.zeros(alphas.size)
+        for trainingIdxs,validationIdxs in KFold(n_splits=self.cv).split(x):
+            coefs, intercepts = _ridge_path(x[trainingIdxs], y[trainingIdxs], alphas, self.fitIntercept)
+            scores += _r2_scores(y[validationIdxs], x[validationIdxs] @ coefs + intercepts)
+        self.alpha = alphas[np.argmax(scores)]
+        self.bestScore = scores.max()/self.cv
+        self.predictor = Ridge(alpha=self.alpha, fit_intercept=self.fitIntercept).fit(x, y)
         return self
     
     def predict(self, x):
         return self.predictor.predict(x)
 
 
-from sklearn.linear_model import Lasso
+import time
+from sklearn.linear_model import Lasso, LassoCV
 from sklearn.model_selection import GridSearchCV
+from sklearn.experimental import enable_halving_search_cv
+from sklearn.model_selection import HalvingGridSearchCV
+def _search(estimator, paramGrid, x, y, cv, nJobs, search, randomState=None, resource='n_samples', maxResources='auto'):
+    # 'grid': exhaustive search, 'halving': successive halving over 'resource' (e.g. number of samples or trees);
+    # returns the estimator refitted on all data by the search, its mean CV score, and the search time
+    start = time.time()
+    if search == 'grid':
+        grid = GridSearchCV(estimator, paramGrid, cv=cv, n_jobs=nJobs)
+    elif search == 'halving':
+        grid = HalvingGridSearchCV(estimator, paramGrid, cv=cv, n_jobs=nJobs, random_state=randomState,
+                                   resource=resource, max_resources=maxResources)
+    else:
+        raise ValueError("search must be either 'grid' or 'halving', got %r"%(search))
+    grid.fit(x, y)
+    return grid.best_estimator_, grid.best_score_, time.time() - start
+
 class PredictorLasso:
     def __init__(self, alphas=np.logspace(-6,6,100),
-                 fitIntercept=True, cv=5, nJobs=1):
+                 fitIntercept=True, cv=5, nJobs=1, search='grid'):
         self.alphas = alphas
         self.fitIntercept = fitIntercept
         self.cv = cv
         self.nJobs = nJobs
+        self.search = search
     
     def fit(self, x, y):
-        grid = GridSearchCV(Lasso(
-            fit_intercept=self.fitIntercept),
-            {'alpha':self.alphas},
-            cv=self.cv,
-            n_jobs=self.nJobs
-            )
-        grid.fit(x, y)
-        self.predictor = Lasso(**grid.best_params_, fit_intercept=self.fitIntercept).fit(x, y)
+        # 'path': warm-started coordinate descent along the alpha path (LassoCV, selects by mean squared error;
+        #         'bestScore' is the corresponding R2 approximated with the variance of all y)
+        if self.search == 'path':
+            start = time.time()
+            self.predictor = LassoCV(alphas=self.alphas, fit_intercept=self.fitIntercept, cv=self.cv, n_jobs=self.nJobs).fit(x, y)
+            self.bestScore = 1 - np.min(np.mean(self.predictor.mse_path_, axis=1))/np.var(y)
+            self.searchTime = time.time() - start
+            return self
+        self.predictor, self.bestScore, self.searchTime = _search(
+            Lasso(fit_intercept=self.fitIntercept), {'alpha':self.alphas}, x, y, self.cv, self.nJobs, self.search)
         return self
     
     def predict(self, x):
@@ -84,23 +240,26 @@ class PredictorRF:
     def __init__(self,
      nEstimators=[1, 5, 10, 20, 50, 100, 200, 500, 1000],
      maxFeatures=['auto', 'sqrt', 'log2'],
-     cv=5, nJobs=1
+     cv=5, nJobs=1, search='grid', randomState=None
      ):
         self.nEstimators = nEstimators
         self.maxFeatures = maxFeatures
         self.cv = cv 
         self.nJobs = nJobs
+        self.search = search
+        self.randomState = randomState
 
     def fit(self, x, y):
-        grid=GridSearchCV(
-            RandomForestRegressor(),
+        # successive halving uses the number of trees as resource, up to max(nEstimators)
+        if self.search == 'halving':
+            self.predictor, self.bestScore, self.searchTime = _search(
+                RandomForestRegressor(random_state=self.randomState), {'max_features':self.maxFeatures},
+                x, y, self.cv, self.nJobs, self.search, self.randomState, 'n_estimators', max(self.nEstimators))
+            return self
+        self.predictor, self.bestScore, self.searchTime = _search(
+            RandomForestRegressor(random_state=self.randomState),
             {'n_estimators':self.nEstimators,'max_features':self.maxFeatures},
-            cv=self.cv,
-            n_jobs=self.nJobs
-            )
-        grid.fit(x, y)
-
-        self.predictor = RandomForestRegressor(**grid.best_params_).fit(x, y)
+            x, y, self.cv, self.nJobs, self.search, self.randomState)
         return self
     
     def predict(self, x):
@@ -113,31 +272,39 @@ class PredictorSVR:
      Cs=[0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 50.0, 100.0, 500.0, 1000.0],
      epsilons=[0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 50.0, 100.0],
      cv=5, 
-     nJobs=1
+     nJobs=1,
+     search='grid',
+     randomState=None
      ):
         self.Cs = Cs
         self.epsilons = epsilons
         self.cv = cv 
         self.nJobs = nJobs
+        self.search = search
+        self.randomState = randomState
 
     def fit(self, xScaled, y):
-        grid=GridSearchCV(
-            SVR(),
-            {'C':self.Cs, 'epsilon':self.epsilons},
-            cv=self.cv,
-            n_jobs=self.nJobs
-            )
-        grid.fit(xScaled, y)
-
-        self.predictor = SVR(**grid.best_params_).fit(xScaled, y)
+        self.predictor, self.bestScore, self.searchTime = _search(
+            SVR(), {'C':self.Cs, 'epsilon':self.epsilons},
+            xScaled, y, self.cv, self.nJobs, self.search, self.randomState)
         return self
     
     def predict(self, xScaled):
         return self.predictor.predict(xScaled)
 
 
-from sklearn.model_selection import KFold
-from scipy.optimize import differential_evolution
+from scipy.optimize import differential_evolution, lsq_linear
+import copy
+from joblib import Parallel, delayed
+
+def _fit_predict(predictor, x, y, trainingIdxs=None, validationIdxs=None):
+    # fits 'predictor' on the training rows and predicts the validation rows;
+    # the full arrays are passed so that joblib memory-maps them once for all tasks
+    if trainingIdxs is None:
+        return predictor.fit(x, y), None
+    predictor.fit(x[trainingIdxs], y[trainingIdxs])
+    return predictor, predictor.predict(x[validationIdxs])
+
 class CombinedPredictor:
     def __init__(self, 
         nSplits=5, 
@@ -145,7 +312,10 @@ class CombinedPredictor:
         randomState=12,
         bounds=[(0,10),(0,10)],
         tol=1e-4,
-        predictor2=PredictorRidge()
+        predictor2=PredictorRidge(),
+        solver='lsq',
+        nJobs=1,
+        batchDCA=False
         ):
         self.nSplits = nSplits
         self.shuffle = shuffle
@@ -153,33 +323,116 @@ class CombinedPredictor:
         self.bounds = bounds
         self.tol = tol
         self.predictor2 = predictor2
+        self.solver = solver
+        self.nJobs = nJobs
+        self.batchDCA = batchDCA
 
     def five_fold_split(self, x):
         fiveFold = KFold(n_splits=self.nSplits, random_state=self.randomState, shuffle=self.shuffle)
         return fiveFold.split(x)
     
     def train(self, x, deltaE, y):
-        data = [[] for _ in range(3)]
-        for trainingIdxs,validationIdxs in self.five_fold_split(x):
-            data[0].append(y[validationIdxs])
-            
-            p1 = PredictorDCA()
-            p1.fit(deltaE[trainingIdxs],y[trainingIdxs])
-            data[1].append(p1.predict(deltaE[validationIdxs]))
-            
-            p2 = PredictorRidge()
-            p2.fit(x[trainingIdxs],y[trainingIdxs])
-            data[2].append(p2.predict(x[validationIdxs]))
-            
-        yTrue,yP1,yP2 = [np.concatenate(l) for l in data]
+        # the logistic fits take milliseconds and are done here: the full data fit first, the folds
+        # warm-started from its solution (one batched problem if 'batchDCA');
+        # the ridge fits are independent tasks distributed to 'nJobs' workers and collected
+        # in task order, i.e. the results do not depend on the number of workers
+        folds = list(self.five_fold_split(x))
+        self.p1 = PredictorDCA().fit(deltaE, y)
+        if self.batchDCA:
+            p1Folds = PredictorDCA().fit_folds(deltaE, y, folds, p0=self.p1.params)
+        else:
+            p1Folds = [PredictorDCA().fit(deltaE[trainingIdxs], y[trainingIdxs], p0=self.p1.params) for trainingIdxs,_ in folds]
+
+        tasks = [delayed(_fit_predict)(PredictorRidge(), x, y, trainingIdxs, validationIdxs) for trainingIdxs,validationIdxs in folds]
+        tasks.append(delayed(_fit_predict)(copy.deepcopy(self.predictor2), x, y)) # 'predictor2' may be shared, e.g. the default argument
+        results = Parallel(n_jobs=self.nJobs)(tasks)
+
+        yTrue = np.concatenate([y[validationIdxs] for _,validationIdxs in folds])
+        yP1 = np.concatenate([p1.predict(deltaE[validationIdxs]) for p1,(_,validationIdxs) in zip(p1Folds, folds)])
+        yP2 = np.concatenate([prediction for _,prediction in results[:-1]])
         
-        loss = lambda params: np.sum(np.power(yTrue - params[0]*yP1 - params[1]*yP2, 2))
-        minimizer = differential_evolution(loss, bounds=self.bounds, tol=self.tol)        
-        self.gamma1, self.gamma2 = minimizer.x
+        self.gamma1, self.gamma2 = self.fit_gammas(yTrue, yP1, yP2)
         
-        self.p1 = PredictorDCA().fit(deltaE, y)
-        self.p2 = self.predictor2.fit(x, y)
+        self.p2 = results[-1][0]
+
+        # state for 'update': the outer folds define the blocks of the ridge statistics
+        blocks = np.zeros(y.size, dtype=int)
+        for block,(_,validationIdxs) in enumerate(folds):
+            blocks[validationIdxs] = block
+        self._history = {'deltaE':np.asarray(deltaE, dtype=float), 'y':np.asarray(y, dtype=float), 'blocks':blocks,
+                         'yP2':np.zeros(y.size)}
+        self._history['yP2'][np.concatenate([validationIdxs for _,validationIdxs in folds])] = yP2
+        self._p1Folds = p1Folds
+        if isinstance(self.predictor2, PredictorRidge):
+            self._ridgeStatistics = _RidgeStatistics(len(folds), x.shape[1])
+            self._ridgeStatistics.add(x, y, blocks)
+        return self
+
+    def update(self, xNew, deltaENew, yNew):
+        # incremental counterpart of 'train' for newly measured variants, requires a trained model
+        # with 'predictor2' being a 'PredictorRidge'; only the new rows have to be encoded:
+        # - the new rows are distributed to the blocks (outer folds of 'train') and added to the ridge statistics
+        # - alpha is re-selected by cross-validation over the blocks, computed from the statistics, and used
+        #   for the out-of-fold predictions and the final ridge model (i.e. no nested CV as in 'train')
+        # - the ridge out-of-fold predictions of previous rows are kept as they were (frozen), those of
+        #   the new rows are predicted by the updated held-out-block models
+        # - the logistic fits (full data and folds) are warm-started on the stored deltaE and y
+        # - gamma1 and gamma2 are re-fitted on all out-of-fold predictions
+        if not hasattr(self, '_ridgeStatistics'):
+            raise TypeError('update requires a model trained with predictor2 being a PredictorRidge')
+        xNew = np.asarray(xNew, dtype=float)
+        deltaENew, yNew = np.asarray(deltaENew, dtype=float), np.asarray(yNew, dtype=float)
+        history, statistics = self._history, self._ridgeStatistics
+        nBlocks = statistics.n.size
+
+        blocksNew = (history['y'].size + np.arange(yNew.size)) % nBlocks
+        statistics.add(xNew, yNew, blocksNew)
+
+        alphas = np.asarray(self.predictor2.alphas, dtype=float)
+        fitIntercept = self.predictor2.fitIntercept
+        scores, models = np.zeros(alphas.size), []
+        for block in range(nBlocks):
+            coefs, intercepts = statistics.path(alphas, fitIntercept, heldOut=block)
+            scores += statistics.r2_scores(block, coefs, intercepts)
+            models.append((coefs, intercepts))
+        best = np.argmax(scores)
+
+        yP2New = np.zeros(yNew.size)
+        for block,(coefs, intercepts) in enumerate(models):
+            rows = blocksNew == block
+            yP2New[rows] = xNew[rows] @ coefs[:,best] + intercepts[best]
+
+        history = self._history = {'deltaE':np.concatenate([history['deltaE'], deltaENew]), 'y':np.concatenate([history['y'], yNew]),
+                                   'blocks':np.concatenate([history['blocks'], blocksNew]), 'yP2':np.concatenate([history['yP2'], yP2New])}
+        deltaE, y, blocks = history['deltaE'], history['y'], history['blocks']
+
+        self.p1 = PredictorDCA().fit(deltaE, y, p0=self.p1.params)
+        folds = [(np.flatnonzero(blocks != block), np.flatnonzero(blocks == block)) for block in range(nBlocks)]
+        if self.batchDCA:
+            self._p1Folds = PredictorDCA().fit_folds(deltaE, y, folds, p0=self.p1.params)
+        else:
+            self._p1Folds = [PredictorDCA().fit(deltaE[trainingIdxs], y[trainingIdxs], p0=p1.params)
+                             for p1,(trainingIdxs,_) in zip(self._p1Folds, folds)]
+        yP1 = np.zeros(y.size)
+        for p1,(_,validationIdxs) in zip(self._p1Folds, folds):
+            yP1[validationIdxs] = p1.predict(deltaE[validationIdxs])
+
+        self.gamma1, self.gamma2 = self.fit_gammas(y, yP1, history['yP2'])
+
+        coefs, intercepts = statistics.path(alphas[best:best+1], fitIntercept)
+        self.p2.predictor = _RidgeModel(coefs[:,0], intercepts[0], alphas[best])
         return self
     
+    def fit_gammas(self, yTrue, yP1, yP2):
+        # 'lsq': exact solution of the bounded linear least squares problem
+        # 'de': global optimization of the same loss by differential evolution
+        if self.solver == 'lsq':
+            lower, upper = np.array(self.bounds, dtype=float).T
+            return lsq_linear(np.column_stack([yP1, yP2]), yTrue, bounds=(lower, upper)).x
+        elif self.solver == 'de':
+            loss = lambda params: np.sum(np.power(yTrue - params[0]*yP1 - params[1]*yP2, 2))
+            return differential_evolution(loss, bounds=self.bounds, tol=self.tol).x
+        raise ValueError("solver must be either 'lsq' or 'de', got %r"%(self.solver))
+
     def predict(self, x, deltaE):
         return self.gamma1 * self.p1.predict(deltaE) + self.gamma2 * self.p2.predict(x)
@@ -0,0 +1,157 @@
+# version         v0.1.7
+# date            30.01.2024
+# author          Alexander-Maurice Illig
+# affilation      Institute of Biotechnology, RWTH Aachen
+# email           a.illig@biotec.rwth-aachen.de
+
+import os
+import numpy as np
+
+from ._utils import X_to_deltaE
+
+class _NpyAppender:
+    """
+    Description
+    -----------
+    Writes a .npy file row block by row block. The header is reserved with a fixed size
+    and rewritten with the final number of rows when the file is closed.
+
+    Attributes
+    ----------
+    npyFile : str
+        Name of the .npy file.
+    dtype : str
+        Data type of the array.
+    rowShape : tuple
+        Shape of a single row, i.e. the array has the shape (nRows, *rowShape).
+    """
+    _headerSize = 256
+
+    def __init__(self, npyFile:str, dtype, rowShape=()):
+        self.dtype = np.dtype(dtype)
+        self.rowShape = tuple(int(n) for n in rowShape)
+        self.nRows = 0
+        self._file = open(npyFile, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }"%(
+            np.lib.format.dtype_to_descr(self.dtype), (self.nRows, *self.rowShape))
+        header = header.ljust(self._headerSize - 10 - 1) + '\n'
+        self._file.seek(0)
+        self._file.write(b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1'))
+
+    def append(self, rows:np.ndarray):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape(-1, *self.rowShape)
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(rows.tobytes())
+        self.nRows += rows.shape[0]
+
+    def close(self):
+        self._write_header()
+        self._file.close()
+
+class NpyWriter:
+    """
+    Description
+    -----------
+    Output sink that writes encoded variants in a binary, memory-mappable format to 'directory':
+        X.npy        : encoded sequences (nVariants, L) as 'dtype'
+        deltaE.npy   : deltaE values (nVariants,) as float64
+        y.npy        : fitness values (nVariants,) as float64
+        xWt.npy      : encoded wild type (L,) as float64
+        variants.txt : variant names, one per line
+    Use 'load_data' to read the data.
+
+    Attributes
+    ----------
+    directory : str
+        Name of the output directory (created if it does not exist).
+    xWt : np.ndarray
+        Encoded wild type sequence used to calculate deltaE.
+    dtype : str
+        Data type of the stored encoded sequences (default='float32').
+    """
+    def __init__(self, directory:str, xWt:np.ndarray, dtype='float32'):
+        self.directory = directory
+        self.xWt = np.asarray(xWt, dtype=float)
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'xWt.npy'), self.xWt)
+
+        self._X = _NpyAppender(os.path.join(directory, 'X.npy'), dtype, self.xWt.shape)
+        self._deltaE = _NpyAppender(os.path.join(directory, 'deltaE.npy'), float)
+        self._y = _NpyAppender(os.path.join(directory, 'y.npy'), float)
+        self._variants = open(os.path.join(directory, 'variants.txt'), 'w')
+
+    def write(self, variants:np.ndarray, X:np.ndarray, fitnesses:np.ndarray):
+        X = np.asarray(X, dtype=float).reshape(-1, self.xWt.size)
+        self._X.append(X)
+        self._deltaE.append(X_to_deltaE(X, self.xWt))
+        self._y.append(np.asarray(fitnesses, dtype=float))
+        self._variants.writelines('%s\n'%(variant) for variant in variants)
+
+    def close(self):
+        self._X.close()
+        self._deltaE.close()
+        self._y.close()
+        self._variants.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def save_data(data:np.ndarray, directory:str, xWt:np.ndarray, dtype='float32'):
+    """
+    Description
+    -----------
+    Binary counterpart of 'generate_dataframe', writes the output of 'get_data' to 'directory' (see 'NpyWriter').
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Filled numpy array including variant names, encoded sequences, and fitnesses.
+    directory : str
+        Name of the output directory.
+    xWt : np.ndarray
+        Encoded wild type sequence.
+    dtype : str
+        Data type of the stored encoded sequences (default='float32').
+    """
+    variants,X,fitnesses=np.array(data,dtype=object).T
+    with NpyWriter(directory, xWt, dtype) as writer:
+        if variants.size:
+            writer.write(variants, np.stack(X), fitnesses.astype(float))
+
+def load_data(directory:str, mmap=True) -> tuple:
+    """
+    Description
+    -----------
+    Reads data written by 'NpyWriter', 'save_data', or 'stream_data'.
+
+    Parameters
+    ----------
+    directory : str
+        Name of the directory.
+    mmap : bool
+        If True, the arrays are memory-mapped read-only instead of being read into memory (default=True).
+
+    Returns
+    -------
+    variants : np.ndarray
+        Variant names.
+    X : np.ndarray
+        Encoded sequences.
+    deltaE : np.ndarray
+        DeltaE values.
+    y : np.ndarray
+        Fitness values.
+    """
+    mmapMode = 'r' if mmap else None
+    X = np.load(os.path.join(directory, 'X.npy'), mmap_mode=mmapMode)
+    deltaE = np.load(os.path.join(directory, 'deltaE.npy'), mmap_mode=mmapMode)
+    y = np.load(os.path.join(directory, 'y.npy'), mmap_mode=mmapMode)
+    with open(os.path.join(directory, 'variants.txt')) as f:
+        variants = np.array(f.read().splitlines())
+    return variants, X, deltaE, y
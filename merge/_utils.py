@@ -102,6 +102,26 @@ def get_single_substitutions(variant:str, separator=',') -> object:
     else:
         raise InvalidVariantError(variant)
 
+def canonicalize_variant(variant:str, separator=',') -> str:
+    """
+    Description
+    -----------
+    Returns a unique representation of the variant: substitutions sorted by position and
+    joined by ','. If a position is substituted more than once, the last substitution is kept.
+
+    Parameters
+    ----------
+    See 'is_valid_variant' for an explanation.
+
+    Returns
+    -------
+    Canonicalized variant as string.
+    """
+    substitutions = {}
+    for substitution in get_single_substitutions(variant, separator):
+        substitutions[int(substitution[1:-1])] = substitution
+    return ','.join(substitutions[position] for position in sorted(substitutions))
+
 def X_to_deltaE(x:np.ndarray, xWt:np.ndarray) -> float:
     """
     Description